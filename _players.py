@@ -4,8 +4,12 @@ import os
 import json
 import time
 import asyncio # to autoclose lobbies
-from copy import copy
-from basic_functions import debug_print
+from array import array
+from itertools import repeat
+from collections.abc import Mapping, MutableMapping
+from basic_functions import debug_print, offload
+from storage_worker import Storage
+from cold_storage import ColdStore
 
 DEFAULT_ELO = 1000.0 # only used for new Players
 
@@ -16,12 +20,20 @@ class PlayerManager():
   players: dict[str, Player] = {}
   id_map: dict[str, str] = {} # curr -> prev; no Discord interface yet
   should_save: bool = False # dirty bit to track changes
+  saves: int = 0 # number of saves started, so a slower older save can't win
+  cold_storage: bool = False # hot/cold tiering mode; evicted players are kept by `Storage`
+  resets: int = 0 # number of season resets, so a player read before one isn't rehydrated
+  ratings_frozen: bool = False # while a new season starts (see `Seasons.new_season`)
 
   @classmethod
-  def initialize(cls, filename: str = 'data.json'):
-    """ Initialize the class. """
+  def initialize(cls, filename: str = 'data.json', cold_storage: bool = False):
+    """ Initialize the class. With `cold_storage`, inactive players can be
+        evicted from memory (see `evict_inactive`). """
     cls.filename = filename
+    cls.cold_storage = cold_storage
     cls._load_data()
+    if not cold_storage:
+      cls._load_cold()
 
   @classmethod
   def _load_data(cls) -> None:
@@ -40,17 +52,7 @@ class PlayerManager():
     # Unpack the players
     for p in json_data['players']:
       debug_print('Reading player:', p)
-      ID = p['ID']
-      # Deserialize the records
-      records = {}
-      for r in p['records']:
-        # Move the region and platform from values to keys
-        region = r['region']
-        platform = r['platform']
-        del r['region'], r['platform']
-        records[(region, platform)] = r
-      del p['records'] # use the created `records`, not the loaded one
-      cls.players[ID] = Player(**p, records=records)
+      cls.players[p['ID']] = cls._deserialize(p)
 
     # Unpack the id_map
     for im in json_data['id_map']:
@@ -60,71 +62,203 @@ class PlayerManager():
       debug_print(f'{ref_id} -> {orig_id}')
       cls.id_map[ref_id] = orig_id
 
+  @classmethod
+  def _load_cold(cls) -> None:
+    """ Load the players left in the cold store, if cold storage was used
+        before: they aren't in the players file. """
+    this_dir = os.path.dirname(os.path.abspath(__file__))
+    if not ColdStore.exists(this_dir):
+      return
+    # `Storage` doesn't use the cold store without cold storage
+    cold = ColdStore(this_dir, flag='r')
+    loaded = 0
+    for p in cold.players():
+      if p['ID'] not in cls.players:
+        cls.players[p['ID']] = cls._deserialize(p)
+        loaded += 1
+    cold.close()
+    if loaded:
+      cls.should_save = True
+      debug_print(f"Loaded {loaded} players from the cold store (cold storage is off).")
+
+  @staticmethod
+  def _deserialize(p: dict) -> Player:
+    """ Create a Player from its serialized representation (consumes `p`). """
+    records = {}
+    for r in p['records']:
+      # Move the region and platform from values to keys
+      region = r['region']
+      platform = r['platform']
+      del r['region'], r['platform']
+      records[(region, platform)] = r
+    del p['records'] # use the created `records`, not the loaded one
+    return Player(**p, records=records)
+
   @classmethod
   def debug_print_players(cls) -> None:
     """ Print all players, for debugging. """
     for player in cls.players.values():
-      debug_print(vars(player))
+      debug_print(player.serialize())
 
   @classmethod
-  def get_player(cls, ID: str) -> Player:
-    """ Fetch a player by their ID; Create them if they don't exist;
-        Resolve their ID if it's mapped. Error on a circular pointer chain. """
+  def resolve_ID(cls, ID: str) -> str:
+    """ Follow the id_map from `ID`. Error on a circular pointer chain. """
     checked_IDs = set()
     while ID in cls.id_map:
       if ID in checked_IDs:
         raise RuntimeError("get_player circular pointer error")
       checked_IDs.add(ID)
       ID = cls.id_map[ID]
-    if ID not in cls.players:
+    return ID
+
+  @classmethod
+  async def find_player(cls, ID: str) -> Player | None:
+    """ Fetch a player by their ID without creating them; Return None if
+        they don't exist. Rehydrate them if they were evicted to cold storage
+        (read by `Storage`); Resolve their ID if it's mapped. """
+    ID = cls.resolve_ID(ID)
+    player = cls.players.get(ID)
+    while player is None and cls.cold_storage:
+      resets = cls.resets
+      data = await Storage.request('cold_get', ID)
+      if resets != cls.resets:
+        continue # read before the season's reset; read it again
+      # They may have been rehydrated (or created) meanwhile
+      player = cls.players.get(ID)
+      if player is None and data is not None:
+        # The cold copy is kept until the next eviction overwrites it,
+        # so a crash before the next save can't lose the player
+        debug_print(f"Rehydrating player {ID=}")
+        player = cls.players[ID] = cls._deserialize(data)
+      break
+    return player
+
+  @classmethod
+  async def get_player(cls, ID: str) -> Player:
+    """ Fetch a player by their ID (see `find_player`); Create them if they
+        don't exist. """
+    ID = cls.resolve_ID(ID)
+    player = await cls.find_player(ID)
+    if player is None:
       cls.should_save = True
       debug_print(f"Making a new player with {ID=}")
-      cls.players[ID] = Player(ID)
-    return cls.players[ID]
+      player = cls.players[ID] = Player(ID)
+    return player
+
+  @classmethod
+  def evict_inactive(cls, max_idle: float, pinned: set[str] = frozenset()) -> int:
+    """ Move the players who haven't played for `max_idle` seconds to cold
+        storage, freeing their records.
+        Keep `pinned` IDs (e.g. players in a lobby or queue), since other objects
+        hold their Player. The cold store is written by `Storage`, in one request.
+        Return how many players were evicted. """
+    if not cls.cold_storage or cls.ratings_frozen:
+      return 0
+    now = time.time()
+    evicted = []
+    for ID,player in list(cls.players.items()):
+      if ID in pinned or now - player.last_active < max_idle:
+        continue
+      evicted.append(player.serialize())
+      del cls.players[ID]
+      RecordStore.free_slot(player.slot)
+    if evicted:
+      Storage.submit('cold_evict', evicted)
+      cls.should_save = True
+      debug_print(f"Evicted {len(evicted)} inactive players ({len(cls.players)} left in memory).")
+    return len(evicted)
+
+  @classmethod
+  async def get_leaderboard_rows(cls, region: str, platform: str) -> list[tuple[float, int, str]]:
+    """ Return (elo, matches_total, display_name) of each unbanned player
+        who played in this region/platform (this season), unsorted.
+        Evicted players' rows are read by `Storage`. """
+    table = RecordStore.table(region, platform)
+    rows = [(table.elo[player.slot], table.matches_total[player.slot], player.display_name)
+            for player in cls.players.values()
+            if table.has(player.slot) and table.matches_total[player.slot] > 0
+            and not player.banned]
+    if cls.cold_storage:
+      cold_rows = await Storage.request('cold_records', region, platform)
+      # Rehydrated players' cold copies are stale
+      rows += [(elo, matches_total, name) for elo, matches_total, name, ID in cold_rows
+               if ID not in cls.players]
+    return rows
 
   @classmethod
-  def _serialize(cls) -> dict:
-    """ Create serialized representation of this object, for json. """
+  def _snapshot(cls) -> tuple:
+    """ Copy what `_serialize` needs (cheap: the record columns are copied
+        whole), so that it can run in a thread. Must run on the event loop. """
+    players = [(p.ID, p.banned, p.display_name, p.last_active, p.slot)
+               for p in cls.players.values()]
+    tables = [(couple, table.elo[:], table.matches_total[:], bytes(table.present))
+              for couple,table in zip(RecordStore.codes, RecordStore.tables)]
+    return dict(cls.id_map), players, tables
+
+  @staticmethod
+  def _serialize(snapshot: tuple) -> dict:
+    """ Create serialized representation of a `_snapshot`, for json.
+        Players are serialized like `Player.serialize`. """
+    id_map, players, tables = snapshot
     epoch_time = int(time.time())
     readable_time = time.strftime("%Y-%m-%d at %H:%M:%S %Z")
+    serialized_players = []
+    for ID, banned, display_name, last_active, slot in players:
+      serialized_records = []
+      for (region, platform),elo,matches_total,present in tables:
+        # skip missing and empty records
+        if slot >= len(present) or not present[slot] \
+            or (matches_total[slot] == 0 and elo[slot] == DEFAULT_ELO):
+          continue
+        serialized_records.append({
+          "matches_total": matches_total[slot],
+          "elo": elo[slot],
+          "region": region,
+          "platform": platform,
+        })
+      serialized_players.append({
+        "display_name": display_name,
+        "ID": ID,
+        "records": serialized_records,
+        "banned": banned,
+        "last_active": int(last_active),
+      })
     data = {
       "timestamp": [epoch_time, readable_time],
-      "id_map": cls.id_map,
+      "id_map": id_map,
       "default_elo": DEFAULT_ELO,
-      "players": [player.serialize() for player in cls.players.values()],
+      "players": serialized_players,
     }
     return data
 
   @classmethod
   def save_to_file(cls, backup=False) -> None:
-    """ Save player data to a file, optionally backing up the old file. """
-    this_dir = os.path.dirname(os.path.abspath(__file__))
-    file_path = os.path.join(this_dir, cls.filename)
-    unix_time = int(time.time())
-    old_basename = cls.filename[:-5] # strip ".json"
-    new_backup_name = os.path.join(this_dir, f'{old_basename}-{unix_time}.json')
-    data = cls._serialize()
-    def save(msg: str = "Saving..."):
-      """ Save `data` to `file_path`. Check and update `cls.should_save`. """
-      if cls.should_save:
-        cls.should_save = False
-        debug_print(msg)
-        with open(file_path, 'w', encoding='u8') as f:
-          json.dump(data, f, indent=2)
-      else:
-        debug_print("Not saving: nothing has changed.")
-
-    # Don't check `backup` if `file_path` not present
-    if not os.path.isfile(file_path):
-      save("Saving without backing up...")
+    """ Save player data to a file, optionally also backing it up.
+        The file is written by `Storage` (in the worker process, if any). """
+    if not cls.should_save:
+      debug_print("Not saving: nothing has changed.")
       return
+    cls.should_save = False
+    cls.saves += 1
+    debug_print("Saving...")
+    Storage.submit('write_json', cls.filename, cls._serialize(cls._snapshot()),
+                   backup, cls.cold_storage)
 
-    # Back up (rename instead of overwrite) the old data if applicable
-    if backup and cls.should_save:
-      os.rename(file_path, new_backup_name)
-
-    # Finally, do a generic save
-    save()
+  @classmethod
+  async def save(cls, backup=False) -> None:
+    """ Like `save_to_file`, but serialize the data in a thread; only copying
+        it runs on the event loop. """
+    if not cls.should_save:
+      debug_print("Not saving: nothing has changed.")
+      return
+    cls.should_save = False
+    cls.saves += 1
+    save_number = cls.saves
+    debug_print("Saving...")
+    data = await offload(cls._serialize, cls._snapshot())
+    if save_number != cls.saves:
+      return # a newer save started meanwhile; don't overwrite it with older data
+    Storage.submit('write_json', cls.filename, data, backup, cls.cold_storage)
 
   @classmethod
   def remap_ID(cls, curr_id: str, prev_id: str) -> None:
@@ -140,61 +274,96 @@ class PlayerManager():
     start_time = time.time()
     while True:
       await asyncio.sleep(period)
-      cls.save_to_file(backup=backup)
+      try:
+        await cls.save(backup=backup)
+      except Exception as e:
+        cls.should_save = True # try again next time
+        debug_print(f"Autosave failed: {e!r}")
+
+  @classmethod
+  async def evict_periodically(cls, period: float, max_idle: float, pinned) -> None:
+    """ Start the eviction process. `pinned()` returns the IDs to keep in memory. """
+    while True:
+      await asyncio.sleep(period)
+      cls.evict_inactive(max_idle, pinned())
 
 
 class Player():
-  """ Manage a single player. """
-  # self.records: map[tuple,dict] =
+  """ Manage a single player. Records live in `RecordStore`, indexed by `slot`. """
+  # self.records: Records, a dict-like view over the columnar RecordTables =
   #   { ('NA','PC'): {"matches_total":int, "elo":float}, ... }
+  __slots__ = ('ID', 'banned', 'display_name', 'last_active', 'slot')
+
   def __init__(self,
       ID: str,
       banned: bool = False,
       display_name: str = "",
-      records: dict = None # set to None, because using a mutable default arg is problematic
+      records: dict = None, # set to None, because using a mutable default arg is problematic
+      last_active: float = None, # time of the last match; None means now
     ) -> None:
     self.ID = ID
     self.banned = banned
     self.display_name = display_name
+    self.last_active = time.time() if last_active is None else last_active
+    self.slot = RecordStore.new_slot()
     if records:
-      self.records = records
-    else:
-      self.records = {}
+      for (region, platform),record in records.items():
+        RecordStore.table(region, platform).create(
+          self.slot, record['matches_total'], record['elo']
+        )
 
-  def get_record(self, region, platform) -> dict:
+  @property
+  def records(self) -> Records:
+    """ A dict-like view of this Player's records. """
+    return Records(self.slot)
+
+  def get_record(self, region, platform) -> Record:
     """ Fetch and return record. Create one if it doesn't exist. """
-    couple = (region, platform)
-    if couple not in self.records:
+    table = RecordStore.table(region, platform)
+    if not table.has(self.slot):
       PlayerManager.should_save = True
-      self.records[couple] = {
-        "matches_total": 0,
-        "elo": DEFAULT_ELO
-      }
-    return self.records[couple]
+      table.create(self.slot)
+    return Record(table, self.slot)
 
   def get_elo(self, region, platform) -> float:
     """ Fetch a Player's elo. """
     return self.get_record(region, platform)['elo']
 
+  def record_match(self, region, platform, new_elo: float) -> None:
+    """ Set a Player's elo after a match and count the match. """
+    table = RecordStore.table(region, platform)
+    if not table.has(self.slot):
+      table.create(self.slot)
+    table.elo[self.slot] = new_elo
+    table.matches_total[self.slot] += 1
+    self.last_active = time.time()
+
+  def has_played(self) -> bool:
+    """ Return whether this Player has played any match. """
+    return any(record['matches_total'] > 0 for record in self.records.values())
+
   def serialize(self) -> dict:
     """ Create serialized representation of this object, for saving to json. """
     # tuple cannot be used as a key in json;
     #   move each (region,platform) into the values
     serialized_records = []
-    for (region, platform),value in self.records.items():
-      # skip empty records
-      if value['matches_total'] == 0:
+    for (region, platform),record in self.records.items():
+      # skip empty records (but keep soft-reset Elos from a new season)
+      if record['matches_total'] == 0 and record['elo'] == DEFAULT_ELO:
         continue
-      this_record = copy(value)
-      this_record["region"] = region
-      this_record["platform"] = platform
-      serialized_records.append(this_record)
+      serialized_records.append({
+        "matches_total": record['matches_total'],
+        "elo": record['elo'],
+        "region": region,
+        "platform": platform,
+      })
 
     data = {
       "display_name": self.display_name,
       "ID": self.ID,
       "records": serialized_records,
       "banned": self.banned,
+      "last_active": int(self.last_active),
     }
     return data
 
@@ -213,3 +382,142 @@ class Player():
       output += "and they're BANNED\n"
     output = output.strip()
     return output
+
+
+class RecordTable():
+  """ Columnar storage of every Player's record for one (region, platform),
+      indexed by `Player.slot`. """
+  __slots__ = ('elo', 'matches_total', 'present')
+
+  def __init__(self) -> None:
+    self.elo = array('d')
+    self.matches_total = array('l')
+    self.present = bytearray() # 1 if the slot has a record
+
+  def has(self, slot: int) -> bool:
+    """ Return whether `slot` has a record in this table. """
+    return slot < len(self.present) and self.present[slot] == 1
+
+  def create(self, slot: int, matches_total: int = 0, elo: float = DEFAULT_ELO) -> None:
+    """ Create (or overwrite) the record of `slot`, growing the columns if needed. """
+    missing = slot + 1 - len(self.present)
+    if missing > 0:
+      self.elo.extend(repeat(DEFAULT_ELO, missing))
+      self.matches_total.extend(repeat(0, missing))
+      self.present.extend(bytes(missing))
+    self.elo[slot] = elo
+    self.matches_total[slot] = matches_total
+    self.present[slot] = 1
+
+  def clear(self, slot: int) -> None:
+    """ Delete the record of `slot`, if it has one. """
+    if slot < len(self.present):
+      self.elo[slot] = DEFAULT_ELO
+      self.matches_total[slot] = 0
+      self.present[slot] = 0
+
+
+class RecordStore():
+  """ A singleton class owning the RecordTables and handing out Player slots.
+      Each (region, platform) is interned to a small integer code. """
+  codes: dict[tuple[str, str], int] = {} # (region, platform) -> code
+  tables: list[RecordTable] = [] # code -> table
+  slot_count: int = 0
+  free_slots: list[int] = []
+
+  @classmethod
+  def code(cls, region: str, platform: str) -> int:
+    """ Return the code of (region, platform), creating its table if needed. """
+    couple = (region, platform)
+    code = cls.codes.get(couple)
+    if code is None:
+      code = len(cls.tables)
+      cls.codes[couple] = code
+      cls.tables.append(RecordTable())
+    return code
+
+  @classmethod
+  def table(cls, region: str, platform: str) -> RecordTable:
+    """ Return the table of (region, platform), creating it if needed. """
+    return cls.tables[cls.code(region, platform)]
+
+  @classmethod
+  def new_slot(cls) -> int:
+    """ Hand out an unused slot. """
+    if cls.free_slots:
+      return cls.free_slots.pop()
+    cls.slot_count += 1
+    return cls.slot_count - 1
+
+  @classmethod
+  def reset_ratings(cls, soft_reset: float = 0.0) -> None:
+    """ Reset every record for a new season, in place: zero the match counts and
+        keep `soft_reset` of each Elo's distance from DEFAULT_ELO (0: hard reset). """
+    for table in cls.tables:
+      table.elo = array('d', [DEFAULT_ELO + (elo - DEFAULT_ELO) * soft_reset for elo in table.elo])
+      table.matches_total = array('l', bytes(len(table.matches_total) * table.matches_total.itemsize))
+
+  @classmethod
+  def free_slot(cls, slot: int) -> None:
+    """ Delete every record of `slot` and allow it to be handed out again. """
+    for table in cls.tables:
+      table.clear(slot)
+    cls.free_slots.append(slot)
+
+
+class Records(Mapping):
+  """ A dict-like view of one Player's records: (region, platform) -> Record. """
+  __slots__ = ('slot',)
+
+  def __init__(self, slot: int) -> None:
+    self.slot = slot
+
+  def __getitem__(self, couple: tuple[str, str]) -> Record:
+    code = RecordStore.codes.get(couple)
+    if code is None or not RecordStore.tables[code].has(self.slot):
+      raise KeyError(couple)
+    return Record(RecordStore.tables[code], self.slot)
+
+  def __contains__(self, couple) -> bool:
+    code = RecordStore.codes.get(couple)
+    return code is not None and RecordStore.tables[code].has(self.slot)
+
+  def __iter__(self):
+    for couple,code in RecordStore.codes.items():
+      if RecordStore.tables[code].has(self.slot):
+        yield couple
+
+  def __len__(self) -> int:
+    return sum(1 for _ in self)
+
+
+class Record(MutableMapping):
+  """ A dict-like view of one record: {"matches_total": int, "elo": float}. """
+  __slots__ = ('table', 'slot')
+  keys_ = ('matches_total', 'elo')
+
+  def __init__(self, table: RecordTable, slot: int) -> None:
+    self.table = table
+    self.slot = slot
+
+  def __getitem__(self, key: str):
+    if key not in self.keys_:
+      raise KeyError(key)
+    return getattr(self.table, key)[self.slot]
+
+  def __setitem__(self, key: str, value) -> None:
+    if key not in self.keys_:
+      raise KeyError(key)
+    getattr(self.table, key)[self.slot] = value
+
+  def __delitem__(self, key: str) -> None:
+    raise TypeError("Record fields can't be deleted.")
+
+  def __iter__(self):
+    return iter(self.keys_)
+
+  def __len__(self) -> int:
+    return len(self.keys_)
+
+  def __repr__(self) -> str:
+    return repr(dict(self))
@@ -0,0 +1,245 @@
+""" Module defining the BackupManager class: compressed backups of a JSON file
+    with tiered retention, optionally stored as deltas against a full snapshot.
+
+    Usage:
+      python backups.py list
+      python backups.py restore <timestamp> [output_file]
+        (restoring data.json also rebuilds the cold store, if it was backed up)
+      python backups.py prune
+      python backups.py import-legacy
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+from basic_functions import debug_print
+from cold_storage import ColdStore
+
+# Prefer zstd (Python 3.14+), otherwise fall back to gzip
+try:
+  from compression import zstd as compressor
+  EXTENSION = '.zst'
+except ImportError:
+  import gzip as compressor
+  EXTENSION = '.gz'
+
+BACKUP_DIR = 'backups'
+BACKUP_DELTAS = True # whether to store backups as deltas when smaller
+KEYFRAME_EVERY = 24 # max deltas against one full snapshot
+KEEP_LAST = 6 # the newest backups are always kept
+RETENTION_TIERS = ( # (bucket size in seconds, number of buckets): one backup per bucket
+  (60 * 60, 24),          # hourly for a day
+  (24 * 60 * 60, 14),     # daily for two weeks
+  (7 * 24 * 60 * 60, 12), # weekly for three months
+)
+PLAYER_KEY = 'players' # the list that deltas are computed per item (by "ID")
+
+
+def diff(base: dict, new: dict) -> dict | None:
+  """ Return the delta from `base` to `new`, or None if they can't be diffed. """
+  if not isinstance(base.get(PLAYER_KEY), list) or not isinstance(new.get(PLAYER_KEY), list):
+    return None
+  base_players = {p['ID']: p for p in base[PLAYER_KEY]}
+  new_IDs = {p['ID'] for p in new[PLAYER_KEY]}
+  return {
+    "changed": {k: v for k,v in new.items() if k != PLAYER_KEY and base.get(k) != v},
+    "removed_keys": [k for k in base if k not in new],
+    "players": [p for p in new[PLAYER_KEY] if base_players.get(p['ID']) != p],
+    "removed_players": [ID for ID in base_players if ID not in new_IDs],
+  }
+
+
+def apply(base: dict, delta: dict) -> dict:
+  """ Return `base` with `delta` applied. """
+  data = {k: v for k,v in base.items() if k not in delta['removed_keys']}
+  data.update(delta['changed'])
+  players = {p['ID']: p for p in base[PLAYER_KEY]}
+  for ID in delta['removed_players']:
+    del players[ID]
+  for p in delta['players']:
+    players[p['ID']] = p
+  data[PLAYER_KEY] = list(players.values())
+  return data
+
+
+class BackupManager():
+  """ Manage the backups of one JSON file, e.g. 'data.json'.
+      A backup is either 'data-<time>.full.json<ext>' or
+      'data-<time>.delta-<keyframe time>.json<ext>'. """
+  def __init__(self, this_dir: str, basename: str = 'data') -> None:
+    self.this_dir = this_dir
+    self.basename = basename
+    self.directory = os.path.join(this_dir, BACKUP_DIR)
+    self.pattern = re.compile(
+      rf'{re.escape(basename)}-(\d+)\.(?:full|delta-(\d+))\.json(\.gz|\.zst)$'
+    )
+    self.keyframe: tuple[int, dict] = None # cached (time, data) of the newest full backup
+
+  def list_backups(self) -> list[tuple[int, int | None, str]]:
+    """ Return (time, keyframe time or None, filename) of each backup, oldest first. """
+    if not os.path.isdir(self.directory):
+      return []
+    backups = []
+    for filename in os.listdir(self.directory):
+      match = self.pattern.match(filename)
+      if match:
+        base = int(match.group(2)) if match.group(2) else None
+        backups.append((int(match.group(1)), base, filename))
+    backups.sort()
+    return backups
+
+  def _read(self, filename: str) -> dict:
+    """ Read and decompress one backup file. """
+    with open(os.path.join(self.directory, filename), 'rb') as f:
+      raw = f.read()
+    if filename.endswith('.gz'):
+      import gzip
+      return json.loads(gzip.decompress(raw))
+    from compression import zstd
+    return json.loads(zstd.decompress(raw))
+
+  def _write(self, filename: str, data: dict) -> None:
+    """ Compress and write one backup file, via a temporary file. """
+    os.makedirs(self.directory, exist_ok=True)
+    file_path = os.path.join(self.directory, filename)
+    encoded = json.dumps(data, separators=(',', ':')).encode('u8')
+    with open(file_path + '.tmp', 'wb') as f:
+      f.write(compressor.compress(encoded))
+    os.replace(file_path + '.tmp', file_path)
+
+  def _latest_keyframe(self, backups: list) -> tuple[int, dict] | None:
+    """ Return (time, data) of the newest full backup, using the cache if valid. """
+    full = [ts for ts, base, _ in backups if base is None]
+    if not full:
+      return None
+    if self.keyframe is None or self.keyframe[0] != full[-1]:
+      self.keyframe = (full[-1], self.load(full[-1]))
+    return self.keyframe
+
+  def store(self, data: dict, timestamp: int = None, prune: bool = True) -> str:
+    """ Back up `data` as of `timestamp` (default: now), as a delta if that's
+        enabled and at most half the size of a full backup. Return the filename. """
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    backups = self.list_backups()
+    keyframe = self._latest_keyframe(backups) if BACKUP_DELTAS else None
+    filename = None
+    if keyframe is not None and keyframe[0] < timestamp:
+      deltas = sum(1 for _, base, _ in backups if base == keyframe[0])
+      delta = diff(keyframe[1], data)
+      if delta is not None and deltas < KEYFRAME_EVERY \
+          and len(json.dumps(delta)) * 2 <= len(json.dumps(data)):
+        filename = f'{self.basename}-{timestamp}.delta-{keyframe[0]}.json{EXTENSION}'
+        self._write(filename, delta)
+    if filename is None:
+      filename = f'{self.basename}-{timestamp}.full.json{EXTENSION}'
+      self._write(filename, data)
+      self.keyframe = (timestamp, data)
+    if prune:
+      self.prune(timestamp)
+    return filename
+
+  def load(self, timestamp: int) -> dict:
+    """ Rebuild the data backed up at `timestamp`.
+        Raise KeyError if there's no such backup. """
+    for ts, base, filename in self.list_backups():
+      if ts == timestamp:
+        data = self._read(filename)
+        return data if base is None else apply(self.load(base), data)
+    raise KeyError(f"No backup at {timestamp}.")
+
+  def retained(self, backups: list, now: int) -> set[int]:
+    """ Return the times of the backups to keep under the retention policy. """
+    keep = {ts for ts, _, _ in backups[-KEEP_LAST:]}
+    for size, count in RETENTION_TIERS:
+      buckets = set()
+      for ts, _, _ in reversed(backups): # newest first, so the newest per bucket is kept
+        if now // size - ts // size >= count:
+          break
+        if ts // size not in buckets:
+          buckets.add(ts // size)
+          keep.add(ts)
+    # Keep the full backups that kept deltas (and future deltas) depend on
+    keep |= {base for ts, base, _ in backups if ts in keep and base is not None}
+    full = [ts for ts, base, _ in backups if base is None]
+    if full:
+      keep.add(full[-1])
+    return keep
+
+  def prune(self, now: int = None) -> list[str]:
+    """ Delete backups outside the retention policy. Return their filenames. """
+    now = int(time.time()) if now is None else now
+    backups = self.list_backups()
+    keep = self.retained(backups, now)
+    deleted = []
+    for ts, _, filename in backups:
+      if ts not in keep:
+        os.remove(os.path.join(self.directory, filename))
+        deleted.append(filename)
+    if deleted:
+      debug_print(f"Pruned {len(deleted)} backups.")
+    return deleted
+
+  def import_legacy(self) -> int:
+    """ Move old uncompressed '<basename>-<time>.json' backups into the store.
+        Return how many were imported. """
+    legacy = re.compile(rf'{re.escape(self.basename)}-(\d+)\.json$')
+    found = sorted(
+      (int(match.group(1)), filename)
+      for filename in os.listdir(self.this_dir)
+      if (match := legacy.match(filename))
+    )
+    for timestamp, filename in found:
+      file_path = os.path.join(self.this_dir, filename)
+      with open(file_path, 'r', encoding='u8') as f:
+        self.store(json.load(f), timestamp, prune=False)
+      os.remove(file_path)
+    self.prune()
+    return len(found)
+
+
+def main(argv: list[str]) -> None:
+  """ Command-line tool to inspect, prune and restore backups. """
+  parser = argparse.ArgumentParser(description="Manage data.json backups.")
+  parser.add_argument('--basename', default='data', help="backed-up file without '.json'")
+  commands = parser.add_subparsers(dest='command', required=True)
+  commands.add_parser('list', help="list the backups")
+  restore = commands.add_parser('restore', help="rebuild a backup into a file")
+  restore.add_argument('timestamp', type=int)
+  restore.add_argument('output', nargs='?', help="default: <basename>-restored-<timestamp>.json")
+  commands.add_parser('prune', help="delete backups outside the retention policy")
+  commands.add_parser('import-legacy', help="compress old <basename>-<time>.json backups")
+  args = parser.parse_args(argv)
+
+  this_dir = os.path.dirname(os.path.abspath(__file__))
+  manager = BackupManager(this_dir, args.basename)
+  if args.command == 'list':
+    for ts, base, filename in manager.list_backups():
+      size = os.path.getsize(os.path.join(manager.directory, filename))
+      kind = 'full' if base is None else f'delta of {base}'
+      readable_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts))
+      print(f"{ts}  {readable_time}  {kind:<20} {size:>10} bytes")
+  elif args.command == 'restore':
+    output = args.output or f'{args.basename}-restored-{args.timestamp}.json'
+    with open(output, 'w', encoding='u8') as f:
+      json.dump(manager.load(args.timestamp), f, indent=2)
+    print(f"Restored {args.timestamp} to {output}.")
+    # The cold store (hot/cold tiering mode) is backed up along with data.json
+    cold = BackupManager(this_dir, 'cold_players')
+    if args.basename == 'data' and any(ts == args.timestamp for ts, _, _ in cold.list_backups()):
+      store = ColdStore(os.path.dirname(os.path.abspath(output)),
+                        f'cold_players-restored-{args.timestamp}.db')
+      for player in cold.load(args.timestamp)['players']:
+        store.put(player['ID'], player)
+      store.close()
+      print(f"Restored {args.timestamp} to {store.path} (replaces cold_players.db).")
+  elif args.command == 'prune':
+    print(f"Deleted {len(manager.prune())} backups.")
+  elif args.command == 'import-legacy':
+    print(f"Imported {manager.import_legacy()} backups.")
+
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
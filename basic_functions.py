@@ -1,6 +1,12 @@
 """ Module defining functions used throughout the project. """
 
 import time
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+OFFLOAD_WORKERS = 4 # threads for blocking work moved off the event loop
+_offload_executor = ThreadPoolExecutor(OFFLOAD_WORKERS, thread_name_prefix="offload")
 
 
 def debug_print(*args, timestamp=True, **kwargs):
@@ -40,3 +46,28 @@ def async_cache(func):
     cache[arg] = result
     return result
   return wrapper
+
+
+async def offload(func, *args, **kwargs):
+  """ Run a blocking (CPU- or I/O-heavy) function in a bounded thread pool,
+      so the event loop keeps running; return its result. """
+  loop = asyncio.get_running_loop()
+  return await loop.run_in_executor(_offload_executor, functools.partial(func, *args, **kwargs))
+
+
+class PhaseTimer():
+  """ Time consecutive phases (e.g. of startup) and summarize them. """
+  def __init__(self) -> None:
+    self.start = self.last = time.perf_counter()
+    self.phases: dict[str, float] = {} # phase -> seconds
+
+  def mark(self, phase: str) -> None:
+    """ End `phase` (started when the previous phase ended). """
+    now = time.perf_counter()
+    self.phases[phase] = now - self.last
+    self.last = now
+
+  def summary(self) -> str:
+    """ Return e.g. "load 0.10 s, login 0.52 s, total 0.62 s". """
+    phases = [f"{phase} {seconds:.2f} s" for phase,seconds in self.phases.items()]
+    return ', '.join(phases + [f"total {self.last - self.start:.2f} s"])
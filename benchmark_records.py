@@ -0,0 +1,64 @@
+""" Memory benchmark: columnar Player records vs. the old dict-of-dicts layout.
+    Usage: python benchmark_records.py [num_players] """
+
+import sys
+import gc
+import tracemalloc
+from basic_functions import debug_print
+
+REGIONS = ('NA', 'EU', 'ASIA', 'SA', 'MEA')
+PLATFORMS = ('PC', 'PS')
+RECORDS_PER_PLAYER = 3
+
+
+class LegacyPlayer():
+  """ The old Player layout: a __dict__ and a dict of small dicts. """
+  def __init__(self, ID: str, records: dict) -> None:
+    self.ID = ID
+    self.banned = False
+    self.display_name = f"player{ID}"
+    self.records = records
+
+
+def make_records(i: int) -> dict:
+  """ Create the records of the `i`th player. """
+  couples = [(region, platform) for region in REGIONS for platform in PLATFORMS]
+  return {
+    couples[(i + j) % len(couples)]: {"matches_total": i % 50, "elo": 1000.0 + i % 300}
+    for j in range(RECORDS_PER_PLAYER)
+  }
+
+
+def measure(build) -> tuple[int, object]:
+  """ Return the bytes allocated (and kept) by `build()`, and its result. """
+  gc.collect()
+  tracemalloc.start()
+  result = build()
+  current, _ = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return current, result
+
+
+def main(num_players: int) -> None:
+  """ Build `num_players` players with each layout and print the memory used. """
+  # Import here so RecordStore's tables are only created inside `measure`
+  from _players import Player
+
+  legacy_bytes, legacy = measure(lambda: [
+    LegacyPlayer(str(i), make_records(i)) for i in range(num_players)
+  ])
+  del legacy
+  columnar_bytes, columnar = measure(lambda: [
+    Player(str(i), display_name=f"player{i}", records=make_records(i))
+    for i in range(num_players)
+  ])
+  del columnar
+
+  debug_print(f"{num_players} players, {RECORDS_PER_PLAYER} records each:")
+  debug_print(f"  dict records:     {legacy_bytes / 2**20:8.2f} MiB")
+  debug_print(f"  columnar records: {columnar_bytes / 2**20:8.2f} MiB"
+              f" ({columnar_bytes / legacy_bytes:.0%})")
+
+
+if __name__ == "__main__":
+  main(int(sys.argv[1]) if len(sys.argv) > 1 else 50_000)
@@ -1,7 +1,6 @@
 """ Module providing primary interface for the bot. """
 
 # Not (yet) implemented:
-#   A customized ping system based on region/platform/Elo (not useful for now)
 #   API rate limiter (but shouldn't be a problem)
 
 # TODO: process match log to re-compute Elo upon startup (including using "undo")
@@ -9,10 +8,14 @@
 
 # Note: "admin" here means that people have the "ban_members" permission
 
-from os import getenv
+from os import getenv, path
 import re
+import json
+import hashlib
 from typing import Literal
 import asyncio
+import time
+import io
 
 import discord
 from discord.ext import commands
@@ -21,16 +24,31 @@ from dotenv import load_dotenv
 
 from _players import PlayerManager, Player
 from lobby_manager import LobbyManager
-from basic_functions import debug_print, async_cache
+from matchmaking import MatchmakingQueue, QueueEntry
+from ping_subscriptions import PingSubscriptions
+from storage_worker import Storage
+from elo_history import ChartRenderer
+from head_to_head import HeadToHead
+from seasons import Seasons
+from deferral import adaptive_defer, respond
+from basic_functions import debug_print, async_cache, PhaseTimer
 
 AUTOSAVE = True
-AUTOSAVE_BACKUPS = True # whether to back up previous data while autosaving
+AUTOSAVE_BACKUPS = True # whether to also store a compressed backup (see backups.py) while autosaving
 AUTOSAVE_PERIOD = 10*60 # seconds between each autosave
+LOBBY_SNAPSHOT_PERIOD = 15 # seconds between each snapshot of the open lobbies (if changed)
+STORAGE_WORKER = True # whether saving/logging/queries run in a separate process
+COLD_STORAGE = False # whether inactive players are evicted from memory to 'cold_players.db'
+EVICT_PERIOD = 60*60 # seconds between each eviction pass
+EVICT_AFTER = 30*24*60*60 # seconds without playing before a player is evicted
+COMMAND_HASH_FILE = 'command_tree.sha256' # hash of the last synced command tree
+MESSAGE_LIMIT = 2000 # max characters in a Discord message
 REPORT_STR = "Report bugs to DWouu." # string to append to certain messages
 HELP_STRING = """-# Note: "lobby" here refers to the object that this Discord bot keeps track of internally.
 ```
-/ranked <region> <platform> <ping_users={True|False}>
-        Open a ranked lobby and optionally ping users in the region/platform.
+/ranked <region> <platform> <ping_users={Ping users|Ping nearby Elo|Don't ping users}>
+        Open a ranked lobby and optionally ping users in the region/platform
+        (everyone with the role, or only /subscribe'd users near your Elo).
         The lobby must be periodically updated using /result.
 
 /invite <user>
@@ -42,9 +60,23 @@ HELP_STRING = """-# Note: "lobby" here refers to the object that this Discord bo
 /leave
         Leave a lobby.
 
+/queue <region> <platform>
+        Wait to be matched with a player of similar Elo; a lobby is opened
+        automatically. The allowed Elo difference widens the longer you wait.
+
+/leave_queue
+        Stop waiting in the matchmaking queue.
+
+/subscribe <region> <platform> <band={100|200|400}>
+        Get pinged for lobbies opened within <band> Elo of your own.
+
+/unsubscribe <region> <platform>
+        Stop getting pinged by /subscribe.
+
 /result {I won|I lost|Draw|Undo}
         Report the result of a match (must be in a lobby with the other player).
-        Note: "Undo" has not been implemented yet but will be logged for later.
+        Note: "Undo" removes the last result from the head-to-head record,
+        but doesn't change Elos.
 
 --------------------------------------------------------------------------------
 
@@ -57,6 +89,15 @@ HELP_STRING = """-# Note: "lobby" here refers to the object that this Discord bo
 /leaderboard <region> <platform>
         Display the ranked leaderboard for a region/platform.
 
+/season_leaderboard <season> <region> <platform>
+        Display the final (or current) leaderboard of a season.
+
+/h2h <opponent> <region> <platform> [user]
+        Display a user's (by default your) record against an opponent.
+
+/history <user> <region> <platform> <period={Week|Month|Year|All}>
+        Display a chart of a user's Elo over time.
+
 !ping
         A simple ping-ping test to check if the bot is online.
 
@@ -64,7 +105,14 @@ HELP_STRING = """-# Note: "lobby" here refers to the object that this Discord bo
         [admin-only] Manually save the PlayerManager data.
 
 /ban_ranked <user>
-        [admin-only] Ban a user from using this bot.```"""\
+        [admin-only] Ban a user from using this bot.
+
+/new_season <soft_reset=0>
+        [admin-only] End the season and reset everyone's Elo, keeping a share (0 to 1)
+        of its distance from the default.
+
+/sync_commands
+        [admin-only] Force the slash commands to be re-uploaded to Discord.```"""\
     + f"**{REPORT_STR}**"
 
 
@@ -101,17 +149,47 @@ HELP_STRING = """-# Note: "lobby" here refers to the object that this Discord bo
 intents = discord.Intents.default()
 intents.message_content = True  # see (incoming messages'?) content
 bot = commands.Bot(command_prefix="!", intents=intents)
+startup_timer = PhaseTimer() # logged once, on the first on_ready
 
 
 async def main():
-  """ Initialize PlayerManager, start autosave, and start the bot. """
-  PlayerManager.initialize()
-  if AUTOSAVE:
-    asyncio.create_task(
-      PlayerManager.autosave(period=AUTOSAVE_PERIOD, backup=AUTOSAVE_BACKUPS)
-    )
-  load_dotenv()
-  await bot.start(getenv("DISCORD_TOKEN"))
+  """ Start storage, initialize PlayerManager, start autosave, and start the bot. """
+  Storage.initialize(use_worker=STORAGE_WORKER, cold_storage=COLD_STORAGE)
+  try:
+    PlayerManager.initialize(cold_storage=COLD_STORAGE)
+    PingSubscriptions.initialize()
+    HeadToHead.initialize()
+    Seasons.initialize()
+    await LobbyManager.initialize()
+    if AUTOSAVE:
+      asyncio.create_task(
+        PlayerManager.autosave(period=AUTOSAVE_PERIOD, backup=AUTOSAVE_BACKUPS)
+      )
+      asyncio.create_task(PingSubscriptions.autosave(period=AUTOSAVE_PERIOD))
+      asyncio.create_task(HeadToHead.autosave(period=AUTOSAVE_PERIOD))
+      asyncio.create_task(LobbyManager.autosave(period=LOBBY_SNAPSHOT_PERIOD))
+    if COLD_STORAGE:
+      asyncio.create_task(PlayerManager.evict_periodically(
+        period=EVICT_PERIOD, max_idle=EVICT_AFTER, pinned=pinned_player_IDs
+      ))
+    MatchmakingQueue.on_match = announce_match
+    asyncio.create_task(MatchmakingQueue.run_matcher())
+    startup_timer.mark('data load')
+    load_dotenv()
+    # Same as `bot.start`, split to time the login
+    await bot.login(getenv("DISCORD_TOKEN"))
+    startup_timer.mark('login')
+    await bot.connect()
+  finally:
+    # Save everything so a restart restores it, then let the worker finish
+    # any queued writes
+    LobbyManager.save_to_file()
+    PlayerManager.save_to_file()
+    PingSubscriptions.save_to_file()
+    HeadToHead.save_to_file()
+    Seasons.save_to_file()
+    Storage.close()
+    ChartRenderer.close()
 
 
 ##################
@@ -121,9 +199,22 @@ async def main():
 
 @bot.event
 async def on_ready() -> None:
-  """ When the bot starts up, sync the bot's commands. """
-  await bot.tree.sync()
+  """ When the bot starts up, sync the bot's commands if they changed.
+      This also fires on reconnects, which don't need to sync again
+      (unless the sync failed). """
+  if 'sync' in startup_timer.phases or 'sync (skipped)' in startup_timer.phases:
+    debug_print(f"{bot.user} is online again.")
+    return
+  if 'ready' not in startup_timer.phases:
+    startup_timer.mark('ready')
+  try:
+    synced = await sync_commands()
+  except Exception as e:
+    debug_print(f"Couldn't sync the command tree (retrying on reconnect): {e!r}")
+    return
+  startup_timer.mark('sync' if synced else 'sync (skipped)')
   debug_print(f"{bot.user} is online!")
+  debug_print(f"Startup: {startup_timer.summary()}")
 
 
 @bot.event
@@ -173,25 +264,40 @@ async def on_interaction(itx: discord.Interaction):
 
 @app_commands.default_permissions(ban_members=True)
 @bot.tree.command(name='save', description='Saves player data')
+@adaptive_defer(ephemeral=True)
 async def save(
     itx: discord.Interaction,
     backup: bool,
   ) -> None:
   """ Manually save player data. """
   debug_print('Manually saving PlayerManager...')
-  PlayerManager.save_to_file(backup=backup)
-  await itx.response.send_message('Saved.', ephemeral=True)
+  await PlayerManager.save(backup=backup)
+  await Storage.request('flush') # wait for the write to finish
+  await respond(itx, 'Saved.', ephemeral=True)
+
+
+@app_commands.default_permissions(ban_members=True)
+@bot.tree.command(name='sync_commands', description='Re-upload the slash commands to Discord')
+async def sync_commands_command(itx: discord.Interaction) -> None:
+  """ Force a command tree sync, e.g. if Discord's copy got out of date. """
+  await itx.response.defer(ephemeral=True)
+  await sync_commands(force=True)
+  await itx.followup.send('Synced.', ephemeral=True)
 
 
 @bot.tree.command(name='playerdata', description='Print player data')
+@adaptive_defer(ephemeral=True)
 async def playerdata(
     itx: discord.Interaction,
     user: discord.User,
   ) -> None:
   """ Display data about a player. """
-  player = get_player(user)
+  player = await get_player(user, create=False)
+  if player is None:
+    await respond(itx, f"-# {user.display_name} has no ranked data.", ephemeral=True)
+    return
   response = player.get_summary()
-  await itx.response.send_message(response, ephemeral=True)
+  await respond(itx, response, ephemeral=True)
 
 
 @bot.tree.command(name='help', description="Show a description of each command")
@@ -211,17 +317,18 @@ async def ranked(
     itx: discord.Interaction,
     region: Literal['NA', 'EU', 'ASIA', 'SA', 'MEA'],
     platform: Literal['Steam', 'PS'], # use "Steam", as "PS" ~= "PC" visually
-    ping_users: Literal['Ping users', "Don't ping users"],
+    ping_users: Literal['Ping users', 'Ping nearby Elo', "Don't ping users"],
   ) -> None:
-  """ Open a ranked lobby given region and platform,
-      and optionally ping users that use the role. """
+  """ Open a ranked lobby given region and platform, and optionally ping
+      users that use the role or subscribed users near the host's Elo. """
   if platform == 'Steam':
     platform = 'PC'
   discord_account = itx.user
-  this_player = get_player(discord_account)
+  this_player = await get_player(discord_account)
   # Try making a new lobby for this player and proceed if a new lobby is made.
   try:
     _ = await LobbyManager.new_lobby(this_player, region, platform)
+    MatchmakingQueue.dequeue(this_player)
   except ValueError as e:
     debug_print(e.args)
     await itx.response.send_message(
@@ -250,6 +357,8 @@ async def ranked(
     + f"\n_-# {REPORT_STR}_",
     ephemeral=False
   )
+  if ping_users == "Ping nearby Elo":
+    await ping_subscribers(itx, this_player, region, platform)
   await itx.followup.send("Don't forget to `/invite` people.", ephemeral=True)
 
 
@@ -261,8 +370,8 @@ async def invite(
   """ The caller invites another user to their lobby. """
   try:
     host = itx.user
-    host_player = get_player(host)
-    invitee_player = get_player(invited_user)
+    host_player = await get_player(host)
+    invitee_player = await get_player(invited_user)
     LobbyManager.invite_to_lobby(host_player, invitee_player)
     text = f"<@{host.id}> invited <@{invited_user.id}>"\
       "\n-# use `/join` to join their lobby"
@@ -277,8 +386,8 @@ async def join(
     host_user: discord.User,
   ) -> None:
   """ The caller tries to join another user's lobby. """
-  joiner_player = get_player(itx.user)
-  host_player = get_player(host_user)
+  joiner_player = await get_player(itx.user)
+  host_player = await get_player(host_user)
   # Try finding and joining the lobby
   try:
     LobbyManager.join_lobby(host_player, joiner_player)
@@ -286,6 +395,7 @@ async def join(
     await itx.response.send_message(f"ERROR: {e.args}", ephemeral=True)
   else:
     debug_print("Lobby joined successfully.")
+    MatchmakingQueue.dequeue(joiner_player)
     await itx.response.send_message(
       f"{joiner_player.display_name} joined {host_player.display_name}'s lobby"\
         "\n-# Use `/result` to report the result of each match."
@@ -295,7 +405,7 @@ async def join(
 @bot.tree.command(name='leave', description="Leave the lobby you're in")
 async def leave(itx: discord.Interaction) -> None:
   """ The caller tries to leave their current lobby """
-  player = get_player(itx.user)
+  player = await get_player(itx.user)
   # Try finding and leaving the lobby
   try:
     LobbyManager.leave_lobby(player)
@@ -306,6 +416,76 @@ async def leave(itx: discord.Interaction) -> None:
     await itx.response.send_message(f"{player.display_name} left a lobby")
 
 
+@bot.tree.command(name='queue', description='Wait to be matched with a player of similar Elo')
+async def queue(
+    itx: discord.Interaction,
+    region: Literal['NA', 'EU', 'ASIA', 'SA', 'MEA'],
+    platform: Literal['Steam', 'PS'], # use "Steam", as "PS" ~= "PC" visually
+  ) -> None:
+  """ Add the caller to the matchmaking queue for the region/platform. """
+  if platform == 'Steam':
+    platform = 'PC'
+  this_player = await get_player(itx.user)
+  try:
+    match = await MatchmakingQueue.enqueue(this_player, region, platform, itx.channel)
+  except (ValueError, PermissionError) as e:
+    await itx.response.send_message(f"ERROR: {e.args}", ephemeral=True)
+    return
+  if match is None:
+    await itx.response.send_message(
+      f"You're in the {region}-{platform} queue."
+      "\n-# You'll be pinged when you're matched; use `/leave_queue` to stop waiting.",
+      ephemeral=True
+    )
+  else:
+    await itx.response.send_message(format_match(*match))
+
+
+@bot.tree.command(name='leave_queue', description='Leave the matchmaking queue')
+async def leave_queue(itx: discord.Interaction) -> None:
+  """ Remove the caller from the matchmaking queue. """
+  player = await get_player(itx.user)
+  if MatchmakingQueue.dequeue(player):
+    await itx.response.send_message("You left the queue.", ephemeral=True)
+  else:
+    await itx.response.send_message("You're not in the queue.", ephemeral=True)
+
+
+@bot.tree.command(name='subscribe', description='Get pinged for lobbies near your Elo')
+async def subscribe(
+    itx: discord.Interaction,
+    region: Literal['NA', 'EU', 'ASIA', 'SA', 'MEA'],
+    platform: Literal['Steam', 'PS'], # use "Steam", as "PS" ~= "PC" visually
+    band: Literal[100, 200, 400],
+  ) -> None:
+  """ Subscribe the caller to lobbies within `band` Elo of their own. """
+  if platform == 'Steam':
+    platform = 'PC'
+  player = await get_player(itx.user)
+  PingSubscriptions.subscribe(player, region, platform, band)
+  await itx.response.send_message(
+    f"You'll be pinged for {region}-{platform} lobbies within {band} Elo of"
+    f" yours ({int(player.get_elo(region, platform))}).",
+    ephemeral=True
+  )
+
+
+@bot.tree.command(name='unsubscribe', description='Stop getting pinged for lobbies near your Elo')
+async def unsubscribe(
+    itx: discord.Interaction,
+    region: Literal['NA', 'EU', 'ASIA', 'SA', 'MEA'],
+    platform: Literal['Steam', 'PS'], # use "Steam", as "PS" ~= "PC" visually
+  ) -> None:
+  """ Remove the caller's subscription for the region/platform. """
+  if platform == 'Steam':
+    platform = 'PC'
+  player = await get_player(itx.user)
+  if PingSubscriptions.unsubscribe(player, region, platform):
+    await itx.response.send_message("Unsubscribed.", ephemeral=True)
+  else:
+    await itx.response.send_message("You weren't subscribed.", ephemeral=True)
+
+
 @bot.tree.command(name='result', description='Report the result of a match')
 async def result(
     itx: discord.Interaction,
@@ -315,7 +495,7 @@ async def result(
       If `match_result` == "Undo" then only update the match log,
       otherwise update each player's Elo. """
   discord_account = itx.user
-  this_player = get_player(discord_account)
+  this_player = await get_player(discord_account)
   try:
     # Fetch the player's lobby and the opponent Player; exit if they aren't found
     lobby = LobbyManager.find_lobby(this_player)
@@ -333,9 +513,15 @@ async def result(
     # Handle Undo
     if match_result == 'Undo':
       LobbyManager.update_match_log(lobby['region'], lobby['platform'], winner, loser, undo=True)
-      result_text = "Noted undo (bot has to be reloaded for it to take effect)."
+      if HeadToHead.undo(winner.ID, loser.ID, lobby['region'], lobby['platform']):
+        result_text = "Noted undo: the last result was removed from your head-to-head record"\
+          " (Elos aren't changed)."
+      else:
+        result_text = "Noted undo (there was no result left to undo)."
     else:
       result_text = LobbyManager.report_match_result(winner, draw=(match_result=="Draw"))
+      for player in (winner, loser):
+        PingSubscriptions.refresh(player, lobby['region'], lobby['platform'])
     await itx.response.send_message(result_text, ephemeral=False)
   except Exception as e:
     await itx.response.send_message(f"ERROR: {e.args}", ephemeral=True)
@@ -349,7 +535,7 @@ async def ban_ranked(
     user: discord.User,
   ) -> None:
   """ Ban a user from using the ranked bot. """
-  this_player = get_player(user)
+  this_player = await get_player(user)
   this_player.banned = True
   await itx.response.send_message(
     f"{this_player.display_name} got banned lmao", ephemeral=True
@@ -367,6 +553,7 @@ async def list_lobbies(itx: discord.Interaction) -> None:
 
 
 @bot.tree.command(name='leaderboard', description='Display a leaderboard for the region/platform')
+@adaptive_defer(ephemeral=True)
 async def leaderboard(
     itx: discord.Interaction,
     region: Literal['NA', 'EU', 'ASIA', 'SA', 'MEA'],
@@ -376,29 +563,128 @@ async def leaderboard(
   if platform == 'Steam':
     platform = 'PC'
   try:
-    players = [player for player in PlayerManager.players.values()
-               if (region,platform) in player.records
-               and not player.banned]
-    if players:
-      def sort_by_elo(player: Player):
-        return player.records[(region,platform)]['elo']
-      players.sort(key=sort_by_elo, reverse=True)
-      lines = []
-      for player in players:
-        record = player.records[(region,platform)]
-        elo = record['elo']
-        elo_prefix = '~' if record['matches_total'] < 30 else ' '
-        lines.append(f"{elo_prefix}{int(elo):>4} │ {player.display_name}")
-      header = "``` Elo  │ Player\n"\
-                  "──────┼─────────────────\n"
-      output = header + '\n'.join(lines) + "```"
-      await itx.response.send_message(output, ephemeral=True)
-    else:
-      await itx.response.send_message(
-        'Nobody has played in this region/platform.', ephemeral=True
-      )
-  except Exception as e:
-    debug_print(e.args)
+    # Collecting reads the record columns directly; sorting and formatting is done by `Storage`
+    rows = await PlayerManager.get_leaderboard_rows(region, platform)
+    output = await Storage.request('leaderboard', rows)
+  except Exception as e: # e.g. the storage worker died
+    debug_print(f"/leaderboard failed: {e!r}")
+    await respond(itx, f"ERROR: couldn't compute this leaderboard ({e!r}).", ephemeral=True)
+    return
+  if output:
+    await respond(itx, output, ephemeral=True)
+  else:
+    await respond(itx, 'Nobody has played in this region/platform.', ephemeral=True)
+
+
+@bot.tree.command(name='season_leaderboard', description='Display the leaderboard of a season')
+@adaptive_defer(ephemeral=True, slow=True)
+async def season_leaderboard(
+    itx: discord.Interaction,
+    season: int,
+    region: Literal['NA', 'EU', 'ASIA', 'SA', 'MEA'],
+    platform: Literal['Steam', 'PS'], # use "Steam", as "PS" ~= "PC" visually
+  ) -> None:
+  """ Display the leaderboard of a season, replayed from the match log. """
+  if platform == 'Steam':
+    platform = 'PC'
+  try:
+    rows = await Seasons.get_leaderboard_rows(season, region, platform)
+    output = await Storage.request('leaderboard', rows)
+  except ValueError as e: # no such season
+    await respond(itx, f"ERROR: {e}", ephemeral=True)
+    return
+  except Exception as e: # e.g. a missing or corrupt season archive
+    debug_print(f"/season_leaderboard failed: {e!r}")
+    await respond(itx, f"ERROR: couldn't compute this leaderboard ({e!r}).", ephemeral=True)
+    return
+  if output:
+    await respond(itx, f"-# Season {season}\n{output}", ephemeral=True)
+  else:
+    await respond(itx, 'Nobody played in this region/platform that season.', ephemeral=True)
+
+
+@app_commands.default_permissions(ban_members=True)
+@bot.tree.command(name='new_season', description='End the season and reset Elos')
+@adaptive_defer(slow=True)
+async def new_season(
+    itx: discord.Interaction,
+    soft_reset: app_commands.Range[float, 0, 1] = 0.0,
+  ) -> None:
+  """ End the season: archive every record, then reset the Elos. """
+  try:
+    season = await Seasons.new_season(soft_reset)
+  except ValueError as e: # already starting
+    await respond(itx, f"ERROR: {e}")
+    return
+  except Exception as e: # e.g. the storage worker died
+    debug_print(f"/new_season failed: {e!r}")
+    await respond(itx, f"ERROR: the season wasn't changed ({e!r}).")
+    return
+  # Elo-indexed subscriptions must follow the reset Elos (evicted players' too)
+  PingSubscriptions.reset_ratings(soft_reset)
+  await respond(itx, f"Season {season['number']} has started!")
+
+
+@bot.tree.command(name='h2h', description="Display a user's record against an opponent")
+async def h2h(
+    itx: discord.Interaction,
+    opponent: discord.User,
+    region: Literal['NA', 'EU', 'ASIA', 'SA', 'MEA'],
+    platform: Literal['Steam', 'PS'], # use "Steam", as "PS" ~= "PC" visually
+    user: discord.User = None,
+  ) -> None:
+  """ Display `user`'s (default: the caller's) record against `opponent`. """
+  if platform == 'Steam':
+    platform = 'PC'
+  player = await get_player(user or itx.user, create=False)
+  opponent_player = await get_player(opponent, create=False)
+  if player is None or opponent_player is None:
+    wins, losses, draws = 0, 0, 0
+  else:
+    wins, losses, draws = HeadToHead.get(player.ID, opponent_player.ID, region, platform)
+  if not wins + losses + draws:
+    text = f"{(user or itx.user).display_name} and {opponent.display_name}"\
+      f" haven't played each other in {region}-{platform}."
+  else:
+    text = f"{player.display_name} **{wins} - {losses}** {opponent_player.display_name}"\
+      f" in {region}-{platform}" + (f" ({draws} draws)" if draws else "")
+  await itx.response.send_message(text, ephemeral=True)
+
+
+@bot.tree.command(name='history', description="Display a chart of a user's Elo over time")
+@adaptive_defer(ephemeral=True)
+async def history(
+    itx: discord.Interaction,
+    user: discord.User,
+    region: Literal['NA', 'EU', 'ASIA', 'SA', 'MEA'],
+    platform: Literal['Steam', 'PS'], # use "Steam", as "PS" ~= "PC" visually
+    period: Literal['Week', 'Month', 'Year', 'All'],
+  ) -> None:
+  """ Display a chart of a user's Elo in the region/platform over `period`. """
+  if platform == 'Steam':
+    platform = 'PC'
+  player = await get_player(user, create=False)
+  if player is None:
+    await respond(itx, f"{user.display_name} has no ranked history.", ephemeral=True)
+    return
+  days = {'Week': 7, 'Month': 31, 'Year': 365, 'All': None}[period]
+  since = int(time.time()) - days * 24 * 60 * 60 if days else 0
+  # Reading is done by `Storage` and rendering in a process pool
+  points, resolution = await Storage.request('read_history', player.ID, region, platform, since)
+  if not points:
+    await respond(
+      itx, f"{player.display_name} has no {region}-{platform} history for that period.",
+      ephemeral=True
+    )
+    return
+  png = await ChartRenderer.render(points)
+  elos = [elo for _, elo in points]
+  text = f"{player.display_name} ({region}-{platform}, {period.lower()}):"\
+    f" {int(elos[0])} ➜ **{int(elos[-1])}**"\
+    f"\n-# low {int(min(elos))}, high {int(max(elos))}; one point per {resolution}"
+  await respond(
+    itx, text, file=discord.File(io.BytesIO(png), filename='history.png'), ephemeral=True
+  )
 
 
 ##############
@@ -418,6 +704,30 @@ async def ping(ctx: discord.ext.commands.context.Context) -> None:
 ###################
 
 
+def command_tree_hash() -> str:
+  """ Return a stable hash of the registered (global) command tree. """
+  commands_data = [command.to_dict(bot.tree) for command in bot.tree.get_commands()]
+  commands_data.sort(key=lambda command: (command.get('type', 1), command['name']))
+  encoded = json.dumps(commands_data, sort_keys=True).encode('u8')
+  return hashlib.sha256(encoded).hexdigest()
+
+
+async def sync_commands(force: bool = False) -> bool:
+  """ Sync the command tree if its hash differs from the last synced one
+      (or if `force`). Return whether it synced. """
+  tree_hash = command_tree_hash()
+  file_path = path.join(path.dirname(path.abspath(__file__)), COMMAND_HASH_FILE)
+  if not force and path.isfile(file_path):
+    with open(file_path, 'r', encoding='u8') as f:
+      if f.read().strip() == tree_hash:
+        debug_print("Command tree unchanged; not syncing.")
+        return False
+  debug_print("Syncing the command tree...")
+  await bot.tree.sync()
+  Storage.submit('write_rows', COMMAND_HASH_FILE, [[tree_hash]])
+  return True
+
+
 async def format_message(msg: discord.message.Message) -> str:
   """ Format a message, substituting only mentions for usernames. """
   content = msg.content
@@ -432,12 +742,16 @@ async def format_message(msg: discord.message.Message) -> str:
   return formatted_msg
 
 
-def get_player(user: discord.member.Member) -> Player:
+async def get_player(user: discord.member.Member, create: bool = True) -> Player | None:
   """ Resolve a Player from their Discord user.
       Use this to interface with PlayerManager players, as it can update
-      the Player's display name. """
+      the Player's display name. Without `create`, (for read-only uses)
+      return None instead of creating a Player who doesn't exist. """
   user_id = str(user.id)
-  player: Player = PlayerManager.get_player(user_id)
+  find = PlayerManager.get_player if create else PlayerManager.find_player
+  player: Player = await find(user_id)
+  if player is None:
+    return None
   # Resolve and save display name
   if not player.display_name:
     name = user.global_name if user.global_name else user.display_name
@@ -453,12 +767,65 @@ async def handle_autoreply(msg: discord.message.Message) -> None:
       or re.search(r'help.{0,40}achiev', text)\
       or ('tourn' in text and 'achiev' in text):
     # Skip users who have played at least one match
-    player = get_player(msg.author)
-    if not any(record["matches_total"] > 0
-               for record in player.records.values()):
+    player = await get_player(msg.author, create=False)
+    if player is None or not player.has_played():
       await msg.channel.send(f"You probably won't find anyone to help with getting the tournament achievement here {msg.author.mention}")
 
 
+def pinned_player_IDs() -> set[str]:
+  """ Return the IDs of players who must stay in memory: those in a lobby
+      or the matchmaking queue, whose Player objects are held there. """
+  IDs = {player.ID for player in MatchmakingQueue.queued}
+  for lobby in LobbyManager.lobbies.values():
+    IDs.update(player.ID for player in lobby['players'] | lobby['invited_players'])
+  return IDs
+
+
+def batch_mentions(IDs: list[str], limit: int = MESSAGE_LIMIT) -> list[str]:
+  """ Join user mentions into as few messages as fit within `limit` characters. """
+  batches = []
+  batch = ""
+  for ID in IDs:
+    mention = f"<@{ID}> "
+    if len(batch) + len(mention) > limit:
+      batches.append(batch.strip())
+      batch = ""
+    batch += mention
+  if batch:
+    batches.append(batch.strip())
+  return batches
+
+
+async def ping_subscribers(itx: discord.Interaction, host: Player, region: str, platform: str) -> None:
+  """ Ping the users subscribed to lobbies near `host`'s Elo, logging the cost. """
+  start = time.perf_counter()
+  elo = host.get_elo(region, platform)
+  IDs = [ID for ID in PingSubscriptions.find(region, platform, elo) if ID != host.ID]
+  lookup_time = time.perf_counter() - start
+  start = time.perf_counter()
+  batches = batch_mentions(IDs)
+  for batch in batches:
+    await itx.followup.send(batch)
+  send_time = time.perf_counter() - start
+  debug_print(f"Pinged {len(IDs)} subscribers near {int(elo)} ({region}-{platform}):"
+              f" lookup {lookup_time*1000:.2f} ms,"
+              f" {len(batches)} messages in {send_time*1000:.0f} ms")
+
+
+def format_match(lobby: dict, host: QueueEntry, joiner: QueueEntry) -> str:
+  """ Format the announcement of a matchmade lobby. """
+  return f"<@{host.player.ID}> ({int(host.elo)}) vs <@{joiner.player.ID}> ({int(joiner.elo)})"\
+    f" — matched in lobby #{lobby['ID']} ({lobby['region']}-{lobby['platform']})."\
+    "\n-# Use `/result` to report the result of each match."
+
+
+async def announce_match(lobby: dict, host: QueueEntry, joiner: QueueEntry) -> None:
+  """ Announce a lobby made by the periodic matcher in the host's channel. """
+  channel = host.context or joiner.context
+  if channel is not None:
+    await channel.send(format_match(lobby, host, joiner))
+
+
 @async_cache
 async def bot_fetch_user(user_id: int) -> discord.User:
   """ Fetch a user and cache the result. """
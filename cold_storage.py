@@ -0,0 +1,54 @@
+""" Module defining the ColdStore class: an on-disk store of evicted players. """
+
+import os
+import dbm
+import json
+
+
+class ColdStore():
+  """ Serialized players (see `Player.serialize`) keyed by ID, in a `dbm`
+      database, so inactive players don't have to stay in memory.
+      While the bot runs, only the storage backend (see storage_worker.py)
+      should use this, from the thread that created it: some `dbm` backends
+      are bound to it. """
+  def __init__(self, this_dir: str, filename: str = 'cold_players.db', flag: str = 'c') -> None:
+    self.path = os.path.join(this_dir, filename)
+    self.db = dbm.open(self.path, flag)
+
+  @staticmethod
+  def exists(this_dir: str, filename: str = 'cold_players.db') -> bool:
+    """ Return whether there's a store at this path. """
+    return dbm.whichdb(os.path.join(this_dir, filename)) is not None
+
+  def get(self, ID: str) -> dict | None:
+    """ Return a player's serialized data, or None if they aren't stored. """
+    raw = self.db.get(ID.encode('u8'))
+    return None if raw is None else json.loads(raw)
+
+  def put(self, ID: str, data: dict) -> None:
+    """ Store (or overwrite) a player's serialized data. """
+    self.db[ID.encode('u8')] = json.dumps(data, separators=(',', ':')).encode('u8')
+
+  def delete(self, ID: str) -> None:
+    """ Remove a player, if they're stored. """
+    key = ID.encode('u8')
+    if key in self.db:
+      del self.db[key]
+
+  def IDs(self) -> list[str]:
+    """ Return the ID of every stored player. """
+    return [key.decode('u8') for key in self.db.keys()]
+
+  def players(self) -> list[dict]:
+    """ Return every stored player's serialized data. """
+    return [json.loads(self.db[key]) for key in self.db.keys()]
+
+  def __contains__(self, ID: str) -> bool:
+    return ID.encode('u8') in self.db
+
+  def __len__(self) -> int:
+    return len(self.db)
+
+  def close(self) -> None:
+    """ Close the database. """
+    self.db.close()
@@ -0,0 +1,85 @@
+""" Module defining adaptive deferral for slow slash commands.
+    Handlers decorated with `adaptive_defer` should reply using `respond`. """
+
+import time
+import asyncio
+import functools
+import contextlib
+import discord
+from basic_functions import debug_print
+
+
+class Deferral():
+  """ A singleton class tracking slash commands' latency (time until their
+      first reply) to decide whether to defer them before running them. """
+  defer_threshold = 1.0 # seconds; defer upfront if the expected latency exceeds this
+  watchdog_delay = 2.0 # seconds; defer anyway if there's no reply by then (3 s limit)
+  smoothing = 0.3 # weight of the newest sample in the moving average
+  latencies: dict[str, float] = {} # command name -> moving average latency
+  pending: dict[int, tuple[str, float, asyncio.Lock]] = {}
+  # `pending`: interaction ID -> (command name, start time, lock around replying)
+
+  @classmethod
+  def expected_slow(cls, name: str) -> bool:
+    """ Return whether a command is expected to miss `defer_threshold`. """
+    return cls.latencies.get(name, 0) > cls.defer_threshold
+
+  @classmethod
+  def record(cls, name: str, seconds: float) -> None:
+    """ Update a command's moving average latency. """
+    old = cls.latencies.get(name)
+    new = seconds if old is None else old + cls.smoothing * (seconds - old)
+    cls.latencies[name] = new
+    if (old is not None and old > cls.defer_threshold) != (new > cls.defer_threshold):
+      debug_print(f"/{name} will {'now' if new > cls.defer_threshold else 'no longer'}"
+                  f" be deferred (average {new:.2f} s).")
+
+  @classmethod
+  async def _late_defer(cls, itx: discord.Interaction, lock: asyncio.Lock, ephemeral: bool) -> None:
+    """ Defer `itx` if it hasn't been replied to after `watchdog_delay`. """
+    await asyncio.sleep(cls.watchdog_delay)
+    async with lock:
+      if not itx.response.is_done():
+        debug_print(f"Deferring /{itx.command.name if itx.command else '?'} late.")
+        await itx.response.defer(ephemeral=ephemeral, thinking=True)
+
+
+def adaptive_defer(ephemeral: bool = False, slow: bool = False):
+  """ Decorate a slash command handler to defer it when it's `slow`, or when
+      its measured latency says it will be; otherwise, defer it only if it
+      hasn't replied by `Deferral.watchdog_delay`. `ephemeral` must match the
+      handler's reply, as the deferral decides whether the reply is ephemeral. """
+  def decorator(handler):
+    name = handler.__name__
+    @functools.wraps(handler)
+    async def wrapper(itx: discord.Interaction, *args, **kwargs):
+      lock = asyncio.Lock()
+      watchdog = None
+      if slow or Deferral.expected_slow(name):
+        await itx.response.defer(ephemeral=ephemeral, thinking=True)
+      else:
+        watchdog = asyncio.create_task(Deferral._late_defer(itx, lock, ephemeral))
+      start = time.perf_counter()
+      Deferral.pending[itx.id] = (name, start, lock)
+      try:
+        return await handler(itx, *args, **kwargs)
+      finally:
+        if watchdog is not None:
+          watchdog.cancel()
+        # Record the full duration if the handler never used `respond`
+        if Deferral.pending.pop(itx.id, None) is not None:
+          Deferral.record(name, time.perf_counter() - start)
+    return wrapper
+  return decorator
+
+
+async def respond(itx: discord.Interaction, content: str = None, *, ephemeral: bool = False, **kwargs) -> None:
+  """ Reply to an interaction, with a followup if it was deferred. """
+  name, start, lock = Deferral.pending.pop(itx.id, (None, None, None))
+  if name is not None:
+    Deferral.record(name, time.perf_counter() - start)
+  async with lock or contextlib.nullcontext():
+    if itx.response.is_done():
+      await itx.followup.send(content, ephemeral=ephemeral, **kwargs)
+    else:
+      await itx.response.send_message(content, ephemeral=ephemeral, **kwargs)
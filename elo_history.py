@@ -0,0 +1,153 @@
+""" Module defining the per-player Elo history store and its chart rendering.
+    Each player has their own file, 'elo_history/<ID>.csv', so reading one
+    player's history never touches anyone else's. """
+
+import os
+import zlib
+import struct
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+
+HISTORY_DIR = 'elo_history'
+DAY = 24 * 60 * 60 # seconds
+WEEK = 7 * DAY
+
+
+def history_path(this_dir: str, ID: str) -> str:
+  """ Return the path of a player's history file. """
+  return os.path.join(this_dir, HISTORY_DIR, f'{ID}.csv')
+
+
+def append(this_dir: str, rows: list[tuple[str, str, str, int, float]]) -> None:
+  """ Append (ID, region, platform, timestamp, elo) rows to the players' files. """
+  os.makedirs(os.path.join(this_dir, HISTORY_DIR), exist_ok=True)
+  for ID, region, platform, timestamp, elo in rows:
+    with open(history_path(this_dir, ID), 'a+', encoding='u8') as f:
+      f.write(f'{timestamp},{region},{platform},{elo:.2f}\n') # timestamp,region,platform,elo
+
+
+def read(this_dir: str, ID: str, region: str, platform: str, since: int = 0) -> list[tuple[int, float]]:
+  """ Return a player's (timestamp, elo) points in a region/platform, oldest first. """
+  file_path = history_path(this_dir, ID)
+  if not os.path.isfile(file_path):
+    return []
+  points = []
+  with open(file_path, 'r', encoding='u8') as f:
+    for line in f:
+      timestamp, r, p, elo = line.rstrip('\n').split(',')
+      if r == region and p == platform and int(timestamp) >= since:
+        points.append((int(timestamp), float(elo)))
+  return points
+
+
+def downsample(points: list[tuple[int, float]], bucket: int) -> list[tuple[int, float]]:
+  """ Keep the last point of each `bucket`-second bucket. """
+  output = []
+  for timestamp, elo in points:
+    if output and output[-1][0] // bucket == timestamp // bucket:
+      output[-1] = (timestamp, elo)
+    else:
+      output.append((timestamp, elo))
+  return output
+
+
+def read_downsampled(this_dir: str, ID: str, region: str, platform: str, since: int = 0
+    ) -> tuple[list[tuple[int, float]], str]:
+  """ Return a player's points, downsampled by day or week for long ranges,
+      and a label describing the resolution ("match", "day" or "week"). """
+  points = read(this_dir, ID, region, platform, since)
+  if len(points) < 2:
+    return points, "match"
+  span = points[-1][0] - points[0][0]
+  if span > 365 * DAY:
+    return downsample(points, WEEK), "week"
+  if span > 31 * DAY:
+    return downsample(points, DAY), "day"
+  return points, "match"
+
+
+def render_png(points: list[tuple[int, float]], width: int = 640, height: int = 320) -> bytes:
+  """ Render (timestamp, elo) points as a PNG line chart with Elo grid lines.
+      Uses only the standard library, so it can run in any worker process. """
+  margin = 12
+  pixels = bytearray(b'\xff' * (width * height * 3))
+
+  def set_pixel(x: int, y: int, colour: tuple[int, int, int]) -> None:
+    if 0 <= x < width and 0 <= y < height:
+      i = (y * width + x) * 3
+      pixels[i:i+3] = bytes(colour)
+
+  elos = [elo for _, elo in points] or [0.0]
+  low, high = min(elos), max(elos)
+  padding = max((high - low) * 0.1, 10)
+  low, high = low - padding, high + padding
+  start, end = (points[0][0], points[-1][0]) if points else (0, 1)
+  def to_xy(timestamp: int, elo: float) -> tuple[int, int]:
+    x = margin + (timestamp - start) / max(end - start, 1) * (width - 2*margin)
+    y = height - margin - (elo - low) / (high - low) * (height - 2*margin)
+    return round(x), round(y)
+
+  # Horizontal grid lines at round Elo values (no more than ~8)
+  step = next((s for s in (10, 25, 50, 100, 200, 500) if (high - low) / s <= 8), 1000)
+  grid = (int(low) // step + 1) * step
+  while grid < high:
+    _, y = to_xy(start, grid)
+    for x in range(margin, width - margin):
+      set_pixel(x, y, (220, 220, 220) if grid % (step * 2) else (180, 180, 180))
+    grid += step
+
+  # The line itself (Bresenham, 2px thick), and a dot on each point
+  colour = (40, 90, 200)
+  xys = [to_xy(timestamp, elo) for timestamp, elo in points]
+  for (x0, y0), (x1, y1) in zip(xys, xys[1:]):
+    dx, dy = abs(x1 - x0), -abs(y1 - y0)
+    sx, sy = (1 if x0 < x1 else -1), (1 if y0 < y1 else -1)
+    error = dx + dy
+    while True:
+      set_pixel(x0, y0, colour)
+      set_pixel(x0, y0 + 1, colour)
+      if (x0, y0) == (x1, y1):
+        break
+      e2 = 2 * error
+      if e2 >= dy:
+        error += dy
+        x0 += sx
+      if e2 <= dx:
+        error += dx
+        y0 += sy
+  if len(xys) <= 60:
+    for x, y in xys:
+      for ox in (-1, 0, 1):
+        for oy in (-1, 0, 1):
+          set_pixel(x + ox, y + oy, colour)
+
+  # Encode: each row is prefixed by filter type 0 (None)
+  row_size = width * 3
+  raw = b''.join(b'\x00' + pixels[y*row_size:(y+1)*row_size] for y in range(height))
+  def chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack('>I', len(data)) + kind + data \
+      + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+  header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0) # 8-bit RGB
+  return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) \
+    + chunk(b'IDAT', zlib.compress(raw, 6)) + chunk(b'IEND', b'')
+
+
+class ChartRenderer():
+  """ A singleton class to render charts in a process pool, off the event loop. """
+  pool: ProcessPoolExecutor = None
+  max_workers: int = 1
+
+  @classmethod
+  async def render(cls, points: list[tuple[int, float]]) -> bytes:
+    """ Render `points` with `render_png` in the pool and return the PNG. """
+    if cls.pool is None:
+      cls.pool = ProcessPoolExecutor(max_workers=cls.max_workers)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(cls.pool, render_png, points)
+
+  @classmethod
+  def close(cls) -> None:
+    """ Shut the pool down, if it was started. """
+    if cls.pool is not None:
+      cls.pool.shutdown()
+      cls.pool = None
@@ -0,0 +1,147 @@
+""" Module defining the HeadToHead class. """
+
+import os
+import asyncio
+from storage_worker import Storage
+from basic_functions import debug_print
+
+
+class HeadToHead():
+  """ A singleton class to keep every pair of players' record against each other.
+      Updated incrementally as results are reported, so lookups are O(1). """
+  filename: str = None
+  log_filename: str = 'match_log.csv'
+  recent_depth: int = 8 # results remembered per pair, so they can be undone
+  records: dict[tuple[str, str, str, str], list] = {}
+  # `records`: (A's ID, B's ID, region, platform), with A's ID < B's ID ->
+  #   [A's wins, B's wins, draws, recent results ("A"/"B"/"D", newest last)]
+  log_rows: int = 0 # match log rows counted in `records`; each result/undo is one row
+  should_save: bool = False # dirty bit to track changes
+
+  @classmethod
+  def initialize(cls, filename: str = 'head_to_head.csv') -> None:
+    """ Initialize the class: load the index and catch up with the match log
+        (e.g. after a crash), or rebuild the index from the match log. """
+    cls.filename = filename
+    this_dir = os.path.dirname(os.path.abspath(__file__))
+    file_path = os.path.join(this_dir, cls.filename)
+    log_path = os.path.join(this_dir, cls.log_filename)
+    if not os.path.isfile(file_path):
+      debug_print("No head-to-head file found; rebuilding it from the match log.")
+      cls.rebuild(log_path)
+      return
+    with open(file_path, "r", encoding='u8') as f:
+      header = f.readline().rstrip('\n').split(',')
+      if header[0] != 'log_rows':
+        debug_print("Old head-to-head file found; rebuilding it from the match log.")
+        cls.rebuild(log_path)
+        return
+      covered = int(header[1])
+      for line in f:
+        # A_ID,B_ID,region,platform,A_wins,B_wins,draws,recent
+        a, b, region, platform, a_wins, b_wins, draws, recent = line.rstrip('\n').split(',')
+        cls.records[(a, b, region, platform)] = [int(a_wins), int(b_wins), int(draws), recent]
+    cls.log_rows = 0
+    if not cls._replay(log_path, skip=covered):
+      debug_print("The match log is shorter than the head-to-head file; rebuilding it.")
+      cls.rebuild(log_path)
+      return
+    if cls.log_rows > covered:
+      debug_print(f"Caught up with {cls.log_rows - covered} match log rows.")
+
+  @classmethod
+  def rebuild(cls, log_path: str) -> None:
+    """ Rebuild the index from the match log in one streaming pass. """
+    cls.records = {}
+    cls.log_rows = 0
+    cls._replay(log_path)
+    cls.should_save = True
+
+  @classmethod
+  def _replay(cls, log_path: str, skip: int = 0) -> bool:
+    """ Count the match log rows after the first `skip` ones.
+        Return False if the log has fewer than `skip` rows. """
+    if not os.path.isfile(log_path):
+      return skip == 0
+    with open(log_path, "r", encoding='u8') as f:
+      for line in f:
+        if not line.strip():
+          continue
+        if skip:
+          skip -= 1
+          cls.log_rows += 1
+          continue
+        # timestamp,region,platform,winner_ID,loser_ID,{draw "True", "False", "undo"}
+        _, region, platform, winner_ID, loser_ID, kind = line.rstrip('\n').split(',')
+        if kind == 'undo':
+          cls.undo(winner_ID, loser_ID, region, platform)
+        else:
+          cls.record(winner_ID, loser_ID, region, platform, draw=(kind == 'True'))
+    return skip == 0
+
+  @staticmethod
+  def _key(ID1: str, ID2: str, region: str, platform: str) -> tuple[tuple[str, str, str, str], bool]:
+    """ Return the key of a pair, and whether ID1 is B (the key is swapped). """
+    if ID1 <= ID2:
+      return (ID1, ID2, region, platform), False
+    return (ID2, ID1, region, platform), True
+
+  @classmethod
+  def record(cls, winner_ID: str, loser_ID: str, region: str, platform: str, draw: bool = False) -> None:
+    """ Count a result. In a draw, the order of the IDs doesn't matter. """
+    key, swapped = cls._key(winner_ID, loser_ID, region, platform)
+    record = cls.records.setdefault(key, [0, 0, 0, ""])
+    if draw:
+      result = 'D'
+      record[2] += 1
+    elif swapped: # the winner is B
+      result = 'B'
+      record[1] += 1
+    else:
+      result = 'A'
+      record[0] += 1
+    record[3] = (record[3] + result)[-cls.recent_depth:]
+    cls.log_rows += 1
+    cls.should_save = True
+
+  @classmethod
+  def undo(cls, ID1: str, ID2: str, region: str, platform: str) -> bool:
+    """ Uncount the pair's latest result. Return False if there's none left to undo. """
+    cls.log_rows += 1 # the undo row is logged either way
+    cls.should_save = True
+    key, _ = cls._key(ID1, ID2, region, platform)
+    record = cls.records.get(key)
+    if not record or not record[3]:
+      return False
+    result = record[3][-1]
+    record['ABD'.index(result)] -= 1
+    record[3] = record[3][:-1]
+    return True
+
+  @classmethod
+  def get(cls, ID1: str, ID2: str, region: str, platform: str) -> tuple[int, int, int]:
+    """ Return (ID1's wins, ID2's wins, draws) against each other. """
+    key, swapped = cls._key(ID1, ID2, region, platform)
+    a_wins, b_wins, draws, _ = cls.records.get(key, (0, 0, 0, ""))
+    if swapped:
+      return b_wins, a_wins, draws
+    return a_wins, b_wins, draws
+
+  @classmethod
+  def save_to_file(cls) -> None:
+    """ Save the index to a file (written by `Storage`) if it changed. """
+    if not cls.should_save:
+      return
+    cls.should_save = False
+    rows = [['log_rows', str(cls.log_rows)]] + [
+      [a, b, region, platform, str(a_wins), str(b_wins), str(draws), recent]
+      for (a, b, region, platform),(a_wins, b_wins, draws, recent) in cls.records.items()
+    ]
+    Storage.submit('write_rows', cls.filename, rows)
+
+  @classmethod
+  async def autosave(cls, period: float) -> None:
+    """ Start the autosaving process. """
+    while True:
+      await asyncio.sleep(period)
+      cls.save_to_file()
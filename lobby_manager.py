@@ -1,17 +1,23 @@
 """ Module defining the LobbyManager class. """
 
+import os
+import json
 import time
 import asyncio
-import os
-from _players import Player
+from _players import Player, PlayerManager
+from storage_worker import Storage
+from head_to_head import HeadToHead
 from basic_functions import debug_print, create_elo_function
 
 
 class LobbyManager():
   """ A singleton class to manage lobbies. """
-  elo_function = create_elo_function(K=20, diff=100, xtimes=2)
+  elo_parameters = {"K": 20, "diff": 100, "xtimes": 2} # also used to replay seasons
+  elo_function = create_elo_function(**elo_parameters)
   keepalive_duration = 30 * 60 # seconds; initial time to keep a lobby alive for
   refresh_duration = 3 * 60 # seconds; time to keep a lobby alive without activity
+  filename: str = None # where lobbies are snapshotted, to survive restarts
+  should_save: bool = False # dirty bit to track changes
   lobbies: dict[int, dict] = {} # lobby ID -> {}
   # `lobbies`: key identifier(1,2,3,...) -> Dict:
   #   "ID": int,
@@ -21,24 +27,67 @@ class LobbyManager():
   #   "records": dict[Player, dict[W/L/D/matches_total -> int]]
   #   "invited_players": set[Player]
 
+  @classmethod
+  async def initialize(cls, filename: str = 'lobbies.json') -> None:
+    """ Initialize the class, restoring the snapshotted lobbies if any.
+        Must be called with a running event loop, after PlayerManager. """
+    cls.filename = filename
+    this_dir = os.path.dirname(os.path.abspath(__file__))
+    file_path = os.path.join(this_dir, cls.filename)
+    if not os.path.isfile(file_path):
+      return
+    try:
+      with open(file_path, "r", encoding='u8') as f:
+        json_data = json.load(f)
+    except (OSError, ValueError) as e:
+      debug_print(f"Couldn't read the lobby snapshot; starting with no lobbies: {e!r}")
+      return
+    for l in json_data:
+      # Players who haven't played yet weren't saved with their display name
+      for ID,name in l['display_names'].items():
+        player = await PlayerManager.get_player(ID)
+        player.display_name = player.display_name or name
+      lobby = {
+        "ID": l['ID'],
+        "region": l['region'],
+        "platform": l['platform'],
+        "start_time": l['start_time'],
+        "last_interaction": l['last_interaction'],
+        "players": {await PlayerManager.get_player(ID) for ID in l['players']},
+        "records": {await PlayerManager.get_player(r['ID']): r['record'] for r in l['records']},
+        "invited_players": {await PlayerManager.get_player(ID) for ID in l['invited_players']},
+      }
+      cls.lobbies[lobby['ID']] = lobby
+      # Re-arm the deadlines; lobbies that expired while offline close right away
+      asyncio.create_task(cls.__lobby_autocloser(lobby))
+    debug_print(f"Restored {len(json_data)} lobbies.")
+
   @classmethod
   async def __lobby_autocloser(cls, lobby: dict) -> None:
     """ Periodically check if it's time to close a lobby based on last_interaction."""
-    sleep_duration = cls.keepalive_duration
-    start_time = time.time()
     while True:
-      await asyncio.sleep(sleep_duration)
       now = time.time()
       sleep_duration = \
         max(
           lobby['last_interaction'] + cls.refresh_duration, # since the last refresh
-          start_time + cls.keepalive_duration, # since lobby creation
+          lobby['start_time'] + cls.keepalive_duration, # since lobby creation
         ) - now
       if sleep_duration < 0:
-        debug_print(f"Closing lobby #{lobby['ID']}.")
-        del cls.lobbies[lobby['ID']]
+        cls.close_lobby(lobby)
+        return
+      await asyncio.sleep(sleep_duration)
+      if cls.lobbies.get(lobby['ID']) is not lobby: # closed early
         return
 
+  @classmethod
+  def close_lobby(cls, lobby: dict) -> None:
+    """ Close a lobby, if it's still open. """
+    if cls.lobbies.get(lobby['ID']) is not lobby:
+      return
+    debug_print(f"Closing lobby #{lobby['ID']}.")
+    del cls.lobbies[lobby['ID']]
+    cls.should_save = True
+
   @classmethod
   async def new_lobby(cls, player: Player, region: str, platform: str) -> dict:
     """ Create lobby if player not already in a lobby; return lobby.
@@ -69,6 +118,7 @@ class LobbyManager():
           "invited_players": {player,},
         }
         cls.lobbies[lobby_id] = lobby
+        cls.should_save = True
         debug_print(f'Created lobby #{lobby_id}')
         # Spawn a task to automatically close the lobby
         asyncio.create_task(cls.__lobby_autocloser(lobby))
@@ -79,6 +129,7 @@ class LobbyManager():
     """ Refresh a lobby's last_interaction time. """
     now = time.time()
     lobby['last_interaction'] = now
+    cls.should_save = True
 
   @classmethod
   def find_lobby(cls, player: Player) -> dict:
@@ -94,6 +145,7 @@ class LobbyManager():
     """ Mark a lobby as having had invited `invitee`. """
     lobby = cls.find_lobby(host)
     lobby['invited_players'].add(invitee)
+    cls.should_save = True
 
   @classmethod
   def join_lobby(cls, host: Player, joiner: Player) -> None:
@@ -139,10 +191,14 @@ class LobbyManager():
   def report_match_result(cls, winner: Player, draw: bool = False) -> str:
     """ Update the W/L/D of both players in the lobby and update their Elos.
         Return a formatted string representing the match results.
-        `winner` can be either player in a draw. """
+        `winner` can be either player in a draw.
+        Raise ValueError while a new season is starting. """
+    if PlayerManager.ratings_frozen:
+      raise ValueError("A new season is starting; report the result again in a moment.")
     lobby = cls.find_lobby(winner)
     region = lobby['region']
     platform = lobby['platform']
+    cls.should_save = True
     # Let Player p1 be the winner, and p2 the loser.
     # Update the lobby results.
     p1,p2 = None,None
@@ -177,13 +233,17 @@ class LobbyManager():
     result = cls.elo_function(p1_old_elo, p2_old_elo, p1_wins=(0.5 if draw else 1))
     p1_new_elo = p1_old_elo + result['p1_gain']
     p2_new_elo = p2_old_elo + result['p2_gain']
-    p1.records[(region, platform)]['elo'] = p1_new_elo
-    p2.records[(region, platform)]['elo'] = p2_new_elo
-    p1.records[(region, platform)]['matches_total'] += 1
-    p2.records[(region, platform)]['matches_total'] += 1
+    p1.record_match(region, platform, p1_new_elo)
+    p2.record_match(region, platform, p2_new_elo)
 
-    # Log the result
+    # Log the result, the head-to-head record and the Elo history
     cls.update_match_log(region, platform, p1, p2, draw=draw)
+    HeadToHead.record(p1.ID, p2.ID, region, platform, draw=draw)
+    now = int(time.time())
+    Storage.submit('append_history', [
+      (p1.ID, region, platform, now, p1_new_elo),
+      (p2.ID, region, platform, now, p2_new_elo),
+    ])
 
     # Format the return the results string
     result_text = \
@@ -200,15 +260,39 @@ class LobbyManager():
       draw: bool = False,
       undo: bool = False,
     ) -> str:
-    """ Create a timestamped log entry in 'match_log.csv'. """
-    this_dir = os.path.dirname(os.path.abspath(__file__))
-    file_path = os.path.join(this_dir, "match_log.csv")
-    with open(file_path, 'a+', encoding='u8') as f:
-      f.write( # timestamp,region,platform,winner_ID,loser_ID,{draw "True", "False", "undo"}
-        ','.join([
-          str(int(time.time())), region, platform, winner.ID, loser.ID, 'undo' if undo else str(draw)
-        ]) + '\n'
-      )
+    """ Create a timestamped log entry in 'match_log.csv' (written by `Storage`). """
+    # timestamp,region,platform,winner_ID,loser_ID,{draw "True", "False", "undo"}
+    Storage.submit('log_match', [
+      str(int(time.time())), region, platform, winner.ID, loser.ID, 'undo' if undo else str(draw)
+    ])
+
+  @classmethod
+  def save_to_file(cls) -> None:
+    """ Snapshot the lobbies to a file (written by `Storage`) if they changed. """
+    if not cls.should_save or cls.filename is None:
+      return
+    cls.should_save = False
+    data = [{
+        "ID": lobby['ID'],
+        "region": lobby['region'],
+        "platform": lobby['platform'],
+        "start_time": lobby['start_time'],
+        "last_interaction": lobby['last_interaction'],
+        "players": [player.ID for player in lobby['players']],
+        "records": [{"ID": player.ID, "record": dict(record)}
+                    for player,record in lobby['records'].items()],
+        "invited_players": [player.ID for player in lobby['invited_players']],
+        "display_names": {player.ID: player.display_name
+                          for player in lobby['players'] | lobby['invited_players']},
+      } for lobby in cls.lobbies.values()]
+    Storage.submit('write_json', cls.filename, data)
+
+  @classmethod
+  async def autosave(cls, period: float) -> None:
+    """ Start the snapshotting process. """
+    while True:
+      await asyncio.sleep(period)
+      cls.save_to_file()
 
   @classmethod
   def list_lobbies(cls) -> str:
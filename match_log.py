@@ -0,0 +1,58 @@
+""" Module defining the MatchLog class, and replaying matches to compute ratings. """
+
+import os
+
+
+class MatchLog():
+  """ The match log ('match_log.csv'). Spans of it (e.g. seasons) are given
+      by byte offsets, so reading one seeks straight to it.
+      Only the process owning the log (see storage_worker.py) should use this. """
+  def __init__(self, this_dir: str, filename: str = 'match_log.csv') -> None:
+    self.path = os.path.join(this_dir, filename)
+
+  def append(self, row: list[str]) -> None:
+    """ Append a row (starting with its timestamp). """
+    with open(self.path, 'ab') as f:
+      f.write((','.join(row) + '\n').encode('u8'))
+
+  def position(self) -> int:
+    """ Return the byte offset where the next row will be appended. """
+    return os.path.getsize(self.path) if os.path.isfile(self.path) else 0
+
+  def read_span(self, start: int = 0, end: int = None):
+    """ Yield the rows between byte offsets `start` and `end` (end=None: no limit),
+        e.g. as returned by `position`. """
+    if not os.path.isfile(self.path):
+      return
+    with open(self.path, 'rb') as f:
+      f.seek(start)
+      offset = start
+      for line in f:
+        if end is not None and offset >= end:
+          return
+        offset += len(line)
+        if line.strip():
+          yield line.decode('u8').rstrip('\n').split(',')
+
+
+def replay(rows, region: str, platform: str,
+           starting_elos: dict[str, float], default_elo: float,
+           elo_function) -> list[tuple[float, int, str]]:
+  """ Replay match log rows in a region/platform from `starting_elos`
+      (default: `default_elo`), the way live ratings are computed: "undo" rows
+      don't change Elos. Return (elo, matches_total, ID) of each player who played. """
+  elos: dict[str, float] = {}
+  matches: dict[str, int] = {}
+  for _, r, p, winner, loser, kind in rows:
+    if r != region or p != platform or kind == 'undo':
+      continue
+    for ID in (winner, loser):
+      if ID not in elos:
+        elos[ID] = starting_elos.get(ID, default_elo)
+        matches[ID] = 0
+    result = elo_function(elos[winner], elos[loser], p1_wins=(0.5 if kind == 'True' else 1))
+    elos[winner] += result['p1_gain']
+    elos[loser] += result['p2_gain']
+    matches[winner] += 1
+    matches[loser] += 1
+  return [(elo, matches[ID], ID) for ID,elo in elos.items() if matches[ID] > 0]
@@ -0,0 +1,191 @@
+""" Module defining the MatchmakingQueue class. """
+
+import time
+import asyncio
+from bisect import bisect_left
+from _players import Player
+from lobby_manager import LobbyManager
+from basic_functions import debug_print
+
+
+class QueueEntry():
+  """ A Player waiting in a matchmaking queue. """
+  __slots__ = ('player', 'elo', 'enqueue_time', 'context')
+
+  def __init__(self, player: Player, elo: float, context=None) -> None:
+    self.player = player
+    self.elo = elo
+    self.enqueue_time = time.time()
+    self.context = context # opaque; handed back to `on_match` (e.g. a channel)
+
+  def window(self, now: float) -> float:
+    """ Return the Elo difference this entry accepts after waiting until `now`. """
+    waited = now - self.enqueue_time
+    return min(
+      MatchmakingQueue.base_window + MatchmakingQueue.window_growth * waited,
+      MatchmakingQueue.max_window,
+    )
+
+
+class MatchmakingQueue():
+  """ A singleton class to pair queued players of similar Elo.
+      Each (region, platform) has a list of entries kept sorted by Elo. """
+  base_window = 50 # Elo; difference accepted right after queueing
+  window_growth = 100 / 60 # Elo per second waited
+  max_window = 400 # Elo; the window stops widening here
+  max_wait = 30 * 60 # seconds; entries are dropped after waiting this long
+  match_period = 15 # seconds between batch matching passes
+  queues: dict[tuple[str, str], list[QueueEntry]] = {}
+  queued: dict[Player, tuple[str, str]] = {} # player -> (region, platform)
+  on_match = None # async callback(lobby, entry1, entry2) for batch matches
+
+  @classmethod
+  def _acceptable(cls, a: QueueEntry, b: QueueEntry, now: float) -> bool:
+    """ Return whether a and b are close enough in Elo to be paired.
+        The window of whoever has waited longer is used. """
+    return abs(a.elo - b.elo) <= max(a.window(now), b.window(now))
+
+  @classmethod
+  async def enqueue(cls,
+      player: Player,
+      region: str,
+      platform: str,
+      context=None,
+    ) -> tuple[dict, QueueEntry, QueueEntry] | None:
+    """ Queue `player`, immediately pairing them with their nearest neighbour
+        in Elo if possible. Return (lobby, entry1, entry2) if paired.
+        Raise ValueError if the player is already queued or in a lobby.
+        Raise PermissionError if `player` is banned. """
+    if player.banned:
+      raise PermissionError("You're banned from ranked.")
+    if player in cls.queued:
+      raise ValueError("You're already in the queue (use \"/leave_queue\").")
+    if not cls._is_available(player):
+      raise ValueError("You're already in a lobby (use \"/leave\").")
+    entry = QueueEntry(player, player.get_elo(region, platform), context)
+    queue = cls.queues.setdefault((region, platform), [])
+    # Find the nearest neighbours in Elo in O(log n)
+    i = bisect_left(queue, entry.elo, key=lambda e: e.elo)
+    now = time.time()
+    neighbours = [queue[j] for j in (i-1, i) if 0 <= j < len(queue)]
+    neighbours = [other for other in neighbours if cls._acceptable(entry, other, now)]
+    if neighbours:
+      other = min(neighbours, key=lambda other: abs(other.elo - entry.elo))
+      cls.dequeue(other.player)
+      lobby = await cls._make_lobby(other, entry, region, platform)
+      if lobby is not None:
+        return lobby, other, entry
+      # Keep waiting, along with the partner if they still can play
+      cls._requeue(other, region, platform)
+    if cls._requeue(entry, region, platform):
+      debug_print(f"Queued {player.display_name} ({region}-{platform}, {int(entry.elo)} Elo).")
+    return None
+
+  @classmethod
+  def _requeue(cls, entry: QueueEntry, region: str, platform: str) -> bool:
+    """ Insert `entry` (keeping its wait time) if its player can still play
+        and isn't queued. Return whether it was inserted. """
+    if entry.player.banned or entry.player in cls.queued or not cls._is_available(entry.player):
+      return False
+    queue = cls.queues.setdefault((region, platform), [])
+    queue.insert(bisect_left(queue, entry.elo, key=lambda e: e.elo), entry)
+    cls.queued[entry.player] = (region, platform)
+    return True
+
+  @classmethod
+  def dequeue(cls, player: Player) -> bool:
+    """ Remove `player` from their queue. Return whether they were queued. """
+    couple = cls.queued.pop(player, None)
+    if couple is None:
+      return False
+    queue = cls.queues[couple]
+    elo = player.get_elo(*couple)
+    # Entries keep the Elo they were queued with, which normally matches
+    i = bisect_left(queue, elo, key=lambda e: e.elo)
+    if i < len(queue) and queue[i].player == player:
+      del queue[i]
+    else:
+      queue[:] = [entry for entry in queue if entry.player != player]
+    return True
+
+  @staticmethod
+  def _is_available(player: Player) -> bool:
+    """ Return whether `player` isn't in a lobby. """
+    try:
+      LobbyManager.find_lobby(player)
+    except ValueError:
+      return True
+    return False
+
+  @classmethod
+  async def _make_lobby(cls,
+      host: QueueEntry,
+      joiner: QueueEntry,
+      region: str,
+      platform: str,
+    ) -> dict | None:
+    """ Open a lobby for `host` and have `joiner` join it.
+        Return None if either player can't play anymore. """
+    try:
+      lobby = await LobbyManager.new_lobby(host.player, region, platform)
+    except (ValueError, PermissionError) as e:
+      debug_print(f"Couldn't open a matchmade lobby: {e.args}")
+      return None
+    try:
+      LobbyManager.invite_to_lobby(host.player, joiner.player)
+      LobbyManager.join_lobby(host.player, joiner.player)
+    except (ValueError, PermissionError) as e:
+      debug_print(f"Couldn't join a matchmade lobby: {e.args}")
+      # Don't leave the host alone in it
+      LobbyManager.close_lobby(lobby)
+      return None
+    debug_print(f"Matched {host.player.display_name} with {joiner.player.display_name}"
+                f" in lobby #{lobby['ID']}.")
+    return lobby
+
+  @classmethod
+  async def match_all(cls) -> list[tuple[dict, QueueEntry, QueueEntry]]:
+    """ Pair every queue in one pass over its sorted entries, dropping expired
+        or unavailable entries. Return (lobby, entry1, entry2) for each pair. """
+    now = time.time()
+    pairs = []
+    # Pair without awaiting, so the queues can't change during the pass
+    for (region, platform),queue in cls.queues.items():
+      remaining = []
+      for entry in queue:
+        if now - entry.enqueue_time > cls.max_wait or not cls._is_available(entry.player):
+          debug_print(f"Dropping {entry.player.display_name} from the queue.")
+          del cls.queued[entry.player]
+          continue
+        # Pair with the previous (closest lower) entry if it's still unpaired
+        if remaining and cls._acceptable(remaining[-1], entry, now):
+          other = remaining.pop()
+          del cls.queued[other.player], cls.queued[entry.player]
+          # The longer-waiting player hosts
+          host, joiner = sorted((other, entry), key=lambda e: e.enqueue_time)
+          pairs.append((host, joiner, region, platform))
+          continue
+        remaining.append(entry)
+      queue[:] = remaining
+    matches = []
+    for host, joiner, region, platform in pairs:
+      lobby = await cls._make_lobby(host, joiner, region, platform)
+      if lobby is not None:
+        matches.append((lobby, host, joiner))
+        continue
+      # Keep waiting, if they still can play
+      cls._requeue(host, region, platform)
+      cls._requeue(joiner, region, platform)
+    return matches
+
+  @classmethod
+  async def run_matcher(cls) -> None:
+    """ Start the periodic batch matcher, announcing matches via `on_match`. """
+    while True:
+      await asyncio.sleep(cls.match_period)
+      for lobby, entry1, entry2 in await cls.match_all():
+        if cls.on_match is not None:
+          try:
+            await cls.on_match(lobby, entry1, entry2)
+          except Exception as e:
+            debug_print(f"on_match failed: {e.args}")
@@ -0,0 +1,130 @@
+""" Module defining the PingSubscriptions class. """
+
+import os
+import json
+import asyncio
+from bisect import bisect_left, bisect_right, insort
+from _players import Player, DEFAULT_ELO
+from storage_worker import Storage
+from basic_functions import debug_print
+
+BANDS = (100, 200, 400) # Elo; the bands users can subscribe with
+MAX_CHAR = chr(0x10FFFF) # sorts after every character of an ID
+
+
+class PingSubscriptions():
+  """ A singleton class to manage Elo-band ping subscriptions.
+      Each (region, platform, band) has a list of (elo, ID) kept sorted, so
+      the subscribers whose band contains a lobby's Elo are found with one
+      bisect per band: O(log n + k). """
+  filename: str = None
+  index: dict[tuple[str, str, int], list[tuple[float, str]]] = {}
+  subscriptions: dict[str, dict[tuple[str, str], tuple[int, float]]] = {}
+  # `subscriptions`: ID -> (region, platform) -> (band, elo indexed with)
+  should_save: bool = False # dirty bit to track changes
+
+  @classmethod
+  def initialize(cls, filename: str = 'subscriptions.json') -> None:
+    """ Initialize the class, loading subscriptions from a file if it exists. """
+    cls.filename = filename
+    this_dir = os.path.dirname(os.path.abspath(__file__))
+    file_path = os.path.join(this_dir, cls.filename)
+    if not os.path.isfile(file_path):
+      debug_print("No subscriptions file found.")
+      return
+    with open(file_path, "r", encoding='u8') as f:
+      json_data = json.load(f)
+    for s in json_data:
+      cls._add(s['ID'], s['region'], s['platform'], s['band'], s['elo'])
+
+  @classmethod
+  def _add(cls, ID: str, region: str, platform: str, band: int, elo: float) -> None:
+    """ Add a subscription to both structures. """
+    cls.subscriptions.setdefault(ID, {})[(region, platform)] = (band, elo)
+    insort(cls.index.setdefault((region, platform, band), []), (elo, ID))
+
+  @classmethod
+  def _remove(cls, ID: str, region: str, platform: str) -> bool:
+    """ Remove a subscription from both structures. Return whether it existed. """
+    couples = cls.subscriptions.get(ID, {})
+    if (region, platform) not in couples:
+      return False
+    band, elo = couples.pop((region, platform))
+    if not couples:
+      del cls.subscriptions[ID]
+    entries = cls.index[(region, platform, band)]
+    del entries[bisect_left(entries, (elo, ID))]
+    return True
+
+  @classmethod
+  def subscribe(cls, player: Player, region: str, platform: str, band: int) -> None:
+    """ Subscribe `player` to lobbies within `band` Elo of their own.
+        Replace any existing subscription for this region/platform.
+        Raise ValueError if `band` isn't one of BANDS. """
+    if band not in BANDS:
+      raise ValueError(f"The band must be one of {BANDS}.")
+    cls.should_save = True
+    cls._remove(player.ID, region, platform)
+    cls._add(player.ID, region, platform, band, player.get_elo(region, platform))
+
+  @classmethod
+  def unsubscribe(cls, player: Player, region: str, platform: str) -> bool:
+    """ Remove `player`'s subscription. Return whether they were subscribed. """
+    removed = cls._remove(player.ID, region, platform)
+    cls.should_save |= removed
+    return removed
+
+  @classmethod
+  def refresh(cls, player: Player, region: str, platform: str) -> None:
+    """ Re-index `player`'s subscription after their Elo changed. """
+    subscription = cls.subscriptions.get(player.ID, {}).get((region, platform))
+    if subscription is None:
+      return
+    band, _ = subscription
+    cls._remove(player.ID, region, platform)
+    cls._add(player.ID, region, platform, band, player.get_elo(region, platform))
+    cls.should_save = True
+
+  @classmethod
+  def reset_ratings(cls, soft_reset: float) -> None:
+    """ Re-index every subscription after the Elos were reset for a new
+        season (see `RecordStore.reset_ratings`), without fetching players. """
+    for ID,couples in list(cls.subscriptions.items()):
+      for (region, platform),(band, elo) in list(couples.items()):
+        cls._remove(ID, region, platform)
+        cls._add(ID, region, platform, band, DEFAULT_ELO + (elo - DEFAULT_ELO) * soft_reset)
+    cls.should_save = True
+
+  @classmethod
+  def find(cls, region: str, platform: str, elo: float) -> list[str]:
+    """ Return the IDs of subscribers whose band contains `elo`. """
+    IDs = []
+    for band in BANDS:
+      entries = cls.index.get((region, platform, band))
+      if not entries:
+        continue
+      # (elo, "") sorts before and (elo, MAX_CHAR) after any (elo, ID)
+      start = bisect_left(entries, (elo - band, ""))
+      end = bisect_right(entries, (elo + band, MAX_CHAR))
+      IDs.extend(ID for _, ID in entries[start:end])
+    return IDs
+
+  @classmethod
+  def save_to_file(cls) -> None:
+    """ Save subscriptions to a file (written by `Storage`) if they changed. """
+    if not cls.should_save:
+      return
+    cls.should_save = False
+    data = [
+      {"ID": ID, "region": region, "platform": platform, "band": band, "elo": elo}
+      for ID,couples in cls.subscriptions.items()
+      for (region, platform),(band, elo) in couples.items()
+    ]
+    Storage.submit('write_json', cls.filename, data)
+
+  @classmethod
+  async def autosave(cls, period: float) -> None:
+    """ Start the autosaving process. """
+    while True:
+      await asyncio.sleep(period)
+      cls.save_to_file()
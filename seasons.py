@@ -0,0 +1,126 @@
+""" Module defining the Seasons class. """
+
+import os
+import json
+import time
+from _players import PlayerManager, RecordStore, DEFAULT_ELO
+from storage_worker import Storage
+from lobby_manager import LobbyManager
+from basic_functions import debug_print, offload
+
+
+class Seasons():
+  """ A singleton class to manage ranked seasons. Ending a season archives
+      every record, then resets the ratings in place for the next one.
+      Past seasons' leaderboards are replayed from the match log. """
+  filename: str = None
+  archive_dir: str = 'seasons' # final records of each season: 'season-<number>.json'
+  # (and 'season-<number>-cold.json' for evicted players, in hot/cold tiering mode)
+  seasons: list[dict] = []
+  # `seasons`: oldest first, Dict:
+  #   "number": int,
+  #   "start":_, "end":_ (None for the current season),
+  #   "start_offset": int, "end_offset": int (match log byte offsets; the boundary
+  #     is exact, whereas timestamps only have a one-second resolution),
+  #   "soft_reset": float (share of each Elo's distance from DEFAULT_ELO kept at the start)
+
+  @classmethod
+  def initialize(cls, filename: str = 'seasons.json') -> None:
+    """ Initialize the class. Without a file, the current season is season 1,
+        covering the whole match log. """
+    cls.filename = filename
+    this_dir = os.path.dirname(os.path.abspath(__file__))
+    file_path = os.path.join(this_dir, cls.filename)
+    if os.path.isfile(file_path):
+      with open(file_path, "r", encoding='u8') as f:
+        cls.seasons = json.load(f)
+    else:
+      cls.seasons = [{"number": 1, "start": 0, "end": None,
+                      "start_offset": 0, "end_offset": None, "soft_reset": 0.0}]
+
+  @classmethod
+  def current(cls) -> dict:
+    """ Return the current season. """
+    return cls.seasons[-1]
+
+  @classmethod
+  def get(cls, number: int) -> dict:
+    """ Return a season by its number. Raise ValueError if there's no such season. """
+    if not 1 <= number <= len(cls.seasons):
+      raise ValueError(f"There's no season {number} (the current season is {cls.current()['number']}).")
+    return cls.seasons[number - 1]
+
+  @classmethod
+  def archive_filename(cls, number: int) -> str:
+    """ Return where a season's final records are archived. """
+    return f'{cls.archive_dir}/season-{number}.json'
+
+  @classmethod
+  async def new_season(cls, soft_reset: float = 0.0) -> dict:
+    """ End the current season and start a new one. Return the new season.
+        The records are archived (by `Storage`), then reset in place.
+        Raise ValueError if a new season is already starting; If `Storage`
+        fails, the current season goes on (its archive may be rewritten). """
+    if PlayerManager.ratings_frozen:
+      raise ValueError("A new season is already starting.")
+    now = int(time.time())
+    season = cls.current()
+    archive = cls.archive_filename(season['number'])
+    # No result can be reported (nor player evicted) until the reset, so the
+    # archive, the offset and the reset all see the same ratings
+    PlayerManager.ratings_frozen = True
+    try:
+      data = await offload(PlayerManager._serialize, PlayerManager._snapshot())
+      Storage.submit('write_json', archive, {
+        "season": season['number'],
+        "start": season['start'],
+        "end": now,
+        "players": data['players'],
+      })
+      # Evicted players are archived and reset by `Storage`, which also
+      # returns where the next season starts in the match log
+      offset = await Storage.request('reset_cold', archive, soft_reset, DEFAULT_ELO)
+      RecordStore.reset_ratings(soft_reset)
+    finally:
+      PlayerManager.ratings_frozen = False
+    PlayerManager.should_save = True
+    PlayerManager.resets += 1
+    season['end'] = now
+    season['end_offset'] = offset
+    new = {"number": season['number'] + 1, "start": now, "end": None,
+           "start_offset": offset, "end_offset": None, "soft_reset": soft_reset}
+    cls.seasons.append(new)
+    cls.save_to_file()
+    debug_print(f"Started season {new['number']} ({soft_reset=}).")
+    return new
+
+  @classmethod
+  async def get_leaderboard_rows(cls, number: int, region: str, platform: str
+      ) -> list[tuple[float, int, str]]:
+    """ Return (elo, matches_total, display_name) of each unbanned player who
+        played in a season's region/platform, unsorted.
+        Raise ValueError if there's no such season. """
+    season = cls.get(number)
+    archive = cls.archive_filename(number - 1) if number > 1 else None
+    rows = await Storage.request('season_ratings',
+      season['start_offset'], season['end_offset'], region, platform,
+      archive, season['soft_reset'], DEFAULT_ELO, LobbyManager.elo_parameters,
+    )
+    # Look evicted players up without rehydrating them
+    missing = [ID for _, _, ID in rows if ID not in PlayerManager.players]
+    cold = await Storage.request('cold_lookup', missing) if missing else {}
+    leaderboard = []
+    for elo, matches_total, ID in rows:
+      player = PlayerManager.players.get(ID)
+      if player is not None:
+        name, banned = player.display_name, player.banned
+      else:
+        name, banned = cold.get(ID, (ID, False))
+      if not banned:
+        leaderboard.append((elo, matches_total, name))
+    return leaderboard
+
+  @classmethod
+  def save_to_file(cls) -> None:
+    """ Save the seasons to a file (written by `Storage`). """
+    Storage.submit('write_json', cls.filename, [dict(season) for season in cls.seasons])
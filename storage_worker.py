@@ -0,0 +1,367 @@
+""" Module defining the storage worker, which owns persistence, the match log
+    and heavy queries so that they don't hold up the gateway's event loop. """
+
+import os
+import json
+import time
+import queue
+import signal
+import asyncio
+import itertools
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+import elo_history
+from backups import BackupManager
+from match_log import MatchLog, replay
+from cold_storage import ColdStore
+from basic_functions import debug_print, create_elo_function
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class StorageBackend():
+  """ Carry out storage requests. Lives in the worker process,
+      or in the gateway process when running without a worker. """
+  def __init__(self, this_dir: str = THIS_DIR, cold_storage: bool = False) -> None:
+    self.this_dir = this_dir
+    self.backups: dict[str, BackupManager] = {} # basename -> manager
+    self.match_log = MatchLog(this_dir)
+    self.cold_storage = cold_storage # whether evicted players are kept (see `cold`)
+    self._cold: ColdStore = None
+    self._cold_rows: dict[tuple[str, str], list] = {} # cache of `cold_records`
+    self.handlers = {
+      'flush': self.flush,
+      'write_json': self.write_json,
+      'write_rows': self.write_rows,
+      'log_match': self.log_match,
+      'leaderboard': self.leaderboard,
+      'append_history': self.append_history,
+      'read_history': self.read_history,
+      'match_log_position': self.match_log_position,
+      'season_ratings': self.season_ratings,
+      'cold_evict': self.cold_evict,
+      'cold_records': self.cold_records,
+      'cold_get': self.cold_get,
+      'cold_lookup': self.cold_lookup,
+      'reset_cold': self.reset_cold,
+    }
+
+  @property
+  def cold(self) -> ColdStore | None:
+    """ The store of evicted players (None without cold storage). Opened on
+        first use, by the thread handling requests. """
+    if self._cold is None and self.cold_storage:
+      self._cold = ColdStore(self.this_dir)
+    return self._cold
+
+  def close(self) -> None:
+    """ Close the cold store, if it's open. """
+    if self._cold is not None:
+      self._cold.close()
+      self._cold = None
+
+  def handle(self, op: str, args: tuple):
+    """ Run the handler for `op`. Raise KeyError if `op` is unknown. """
+    return self.handlers[op](*args)
+
+  def flush(self) -> None:
+    """ Do nothing; requests are handled in order, so awaiting this
+        waits for every previously submitted request. """
+
+  def write_json(self, filename: str, data, backup: bool = False, backup_cold: bool = False) -> None:
+    """ Write `data` to `filename` (via a temporary file, so an interrupted
+        write can't leave it truncated), optionally also storing a compressed
+        backup of it (see backups.py). With `backup_cold`, the cold store
+        is backed up too ('cold_players'), with the same timestamp. """
+    file_path = os.path.join(self.this_dir, filename)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path + '.tmp', 'w', encoding='u8') as f:
+      json.dump(data, f, indent=2)
+    os.replace(file_path + '.tmp', file_path)
+    if backup:
+      timestamp = int(time.time())
+      self._backup(filename.removesuffix('.json'), data, timestamp)
+      if backup_cold and self.cold is not None:
+        self._backup('cold_players', {"players": self.cold.players()}, timestamp)
+
+  def _backup(self, basename: str, data: dict, timestamp: int) -> None:
+    """ Store a backup of `data` under `basename`. """
+    if basename not in self.backups:
+      self.backups[basename] = BackupManager(self.this_dir, basename)
+    self.backups[basename].store(data, timestamp)
+
+  def write_rows(self, filename: str, rows: list[list[str]]) -> None:
+    """ Replace `filename` with comma-separated `rows`, via a temporary file. """
+    file_path = os.path.join(self.this_dir, filename)
+    with open(file_path + '.tmp', 'w', encoding='u8') as f:
+      f.writelines(','.join(row) + '\n' for row in rows)
+    os.replace(file_path + '.tmp', file_path)
+
+  def log_match(self, row: list[str]) -> None:
+    """ Append a row to 'match_log.csv'. """
+    self.match_log.append(row)
+
+  def leaderboard(self, rows: list[tuple[float, int, str]]) -> str:
+    """ Sort and format (elo, matches_total, display_name) rows.
+        Return an empty string if there are no rows. """
+    if not rows:
+      return ""
+    rows.sort(key=lambda row: row[0], reverse=True)
+    lines = []
+    for elo, matches_total, display_name in rows:
+      elo_prefix = '~' if matches_total < 30 else ' '
+      lines.append(f"{elo_prefix}{int(elo):>4} │ {display_name}")
+    header = "``` Elo  │ Player\n"\
+                "──────┼─────────────────\n"
+    return header + '\n'.join(lines) + "```"
+
+  def append_history(self, rows: list[tuple[str, str, str, int, float]]) -> None:
+    """ Append (ID, region, platform, timestamp, elo) rows to the Elo history. """
+    elo_history.append(self.this_dir, rows)
+
+  def read_history(self, ID: str, region: str, platform: str, since: int = 0
+      ) -> tuple[list[tuple[int, float]], str]:
+    """ Return a player's downsampled Elo history and its resolution. """
+    return elo_history.read_downsampled(self.this_dir, ID, region, platform, since)
+
+  def match_log_position(self) -> int:
+    """ Return the match log's byte offset after every previously submitted row. """
+    return self.match_log.position()
+
+  def season_ratings(self, start: int, end: int | None, region: str, platform: str,
+      archive: str | None, soft_reset: float, default_elo: float, elo_parameters: dict
+      ) -> list[tuple[float, int, str]]:
+    """ Replay a season's matches (between match log byte offsets `start`
+        and `end`; see `match_log_position`) in a region/platform.
+        Starting Elos are the `archive`d final Elos of the previous season,
+        soft-reset by `soft_reset` (see seasons.py), or `default_elo`.
+        Return (elo, matches_total, ID) of each player who played. """
+    starting_elos = {}
+    if archive is not None:
+      with open(os.path.join(self.this_dir, archive), 'r', encoding='u8') as f:
+        players = json.load(f)['players']
+      # Players who were evicted to the cold store are archived separately
+      cold_archive = os.path.join(self.this_dir, archive.removesuffix('.json') + '-cold.json')
+      if os.path.isfile(cold_archive):
+        with open(cold_archive, 'r', encoding='u8') as f:
+          IDs = {p['ID'] for p in players}
+          players += [p for p in json.load(f)['players'] if p['ID'] not in IDs]
+      for p in players:
+        for r in p['records']:
+          if r['region'] == region and r['platform'] == platform:
+            starting_elos[p['ID']] = default_elo + (r['elo'] - default_elo) * soft_reset
+    return replay(self.match_log.read_span(start, end), region, platform,
+                  starting_elos, default_elo, create_elo_function(**elo_parameters))
+
+  def cold_evict(self, players: list[dict]) -> None:
+    """ Store evicted players' serialized data. """
+    for data in players:
+      self.cold.put(data['ID'], data)
+    self._cold_rows.clear()
+
+  def cold_records(self, region: str, platform: str) -> list[tuple[float, int, str, str]]:
+    """ Return (elo, matches_total, display_name, ID) of each unbanned evicted
+        player who played in this region/platform (this season). """
+    if self.cold is None:
+      return []
+    if (region, platform) not in self._cold_rows:
+      self._cold_rows[(region, platform)] = [
+        (r['elo'], r['matches_total'], data['display_name'], data['ID'])
+        for data in self.cold.players() if not data['banned']
+        for r in data['records']
+        if r['region'] == region and r['platform'] == platform and r['matches_total'] > 0
+      ]
+    return self._cold_rows[(region, platform)]
+
+  def cold_get(self, ID: str) -> dict | None:
+    """ Return an evicted player's serialized data, or None. """
+    return self.cold.get(ID) if self.cold is not None else None
+
+  def cold_lookup(self, IDs: list[str]) -> dict[str, tuple[str, bool]]:
+    """ Return (display_name, banned) of each evicted player in `IDs`. """
+    found = {}
+    for ID in IDs:
+      if self.cold is not None and (data := self.cold.get(ID)) is not None:
+        found[ID] = (data['display_name'], data['banned'])
+    return found
+
+  def reset_cold(self, archive: str, soft_reset: float, default_elo: float) -> int:
+    """ Start a new season for evicted players: archive them (to the `archive`
+        filename, with '-cold' added), then reset their records like
+        `RecordStore.reset_ratings`. Return the match log's position (see
+        `match_log_position`), i.e. where the new season starts. """
+    if self.cold is not None:
+      players = self.cold.players()
+      self.write_json(archive.removesuffix('.json') + '-cold.json', {"players": players})
+      for data in players:
+        for r in data['records']:
+          r['elo'] = default_elo + (r['elo'] - default_elo) * soft_reset
+          r['matches_total'] = 0
+        # Like `Player.serialize`, skip empty records
+        data['records'] = [r for r in data['records'] if r['elo'] != default_elo]
+        self.cold.put(data['ID'], data)
+      self._cold_rows.clear()
+    return self.match_log_position()
+
+
+def _worker_main(requests: multiprocessing.Queue,
+                 responses: multiprocessing.Queue,
+                 this_dir: str,
+                 cold_storage: bool = False) -> None:
+  """ Entry point of the worker process: handle requests until `None`. """
+  # Let the gateway decide when to stop, so queued writes aren't lost on ^C
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  backend = StorageBackend(this_dir, cold_storage)
+  while (message := requests.get()) is not None:
+    request_id, op, args = message
+    try:
+      result, ok = backend.handle(op, args), True
+    except Exception as e:
+      result, ok = e, False
+    if request_id is not None:
+      responses.put((request_id, ok, result))
+    elif not ok:
+      debug_print(f"Storage worker: {op} failed: {result!r}")
+  backend.close()
+  responses.put(None)
+
+
+class Storage():
+  """ A singleton class to send requests to the storage backend, either in
+      a worker process or inline (for a simple single-process deployment,
+      in a thread of this process). Requests are handled in the order they're sent. """
+  backend: StorageBackend = None # inline mode only
+  executor: ThreadPoolExecutor = None # inline mode only; one thread keeps requests in order
+  process: multiprocessing.Process = None
+  requests: multiprocessing.Queue = None
+  responses: multiprocessing.Queue = None
+  reader: threading.Thread = None
+  cold_storage: bool = False # whether the backend keeps evicted players
+  pending: dict[int, tuple[asyncio.AbstractEventLoop, asyncio.Future]] = {}
+  request_ids = itertools.count(1)
+  lock = threading.Lock() # around `process` and `pending`, shared with the reader thread
+  liveness_period = 1.0 # seconds between checks that the worker is alive
+
+  @classmethod
+  def initialize(cls, use_worker: bool = True, cold_storage: bool = False) -> None:
+    """ Start the worker process, or set up the inline backend.
+        With `cold_storage`, the backend keeps players evicted from memory. """
+    cls.cold_storage = cold_storage
+    if not use_worker:
+      cls._inline()
+      return
+    cls.requests = multiprocessing.Queue()
+    cls.responses = multiprocessing.Queue()
+    cls.process = multiprocessing.Process(
+      target=_worker_main,
+      args=(cls.requests, cls.responses, THIS_DIR, cold_storage),
+      name='storage-worker',
+    )
+    cls.process.start()
+    cls.reader = threading.Thread(target=cls._read_responses, daemon=True)
+    cls.reader.start()
+    debug_print(f"Started storage worker (pid {cls.process.pid}).")
+
+  @classmethod
+  def _inline(cls) -> ThreadPoolExecutor:
+    """ Return the inline executor, creating it (and the backend) if needed. """
+    if cls.executor is None:
+      cls.backend = cls.backend or StorageBackend(cold_storage=cls.cold_storage)
+      cls.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='storage')
+    return cls.executor
+
+  @classmethod
+  def _handle_inline(cls, op: str, args: tuple, log_errors: bool = False):
+    """ Handle a request with the inline backend (runs in its thread). """
+    try:
+      return cls.backend.handle(op, args)
+    except Exception as e:
+      if not log_errors:
+        raise
+      debug_print(f"Storage: {op} failed: {e!r}")
+
+  @classmethod
+  def submit(cls, op: str, *args) -> None:
+    """ Send a request without waiting for (or receiving) its result. """
+    with cls.lock:
+      if cls.process is not None:
+        cls.requests.put((None, op, args))
+        return
+    cls._inline().submit(cls._handle_inline, op, args, True)
+
+  @classmethod
+  async def request(cls, op: str, *args):
+    """ Send a request and return its result.
+        Re-raise any exception raised while handling it. """
+    loop = asyncio.get_running_loop()
+    future = None
+    with cls.lock:
+      if cls.process is not None:
+        future = loop.create_future()
+        request_id = next(cls.request_ids)
+        cls.pending[request_id] = (loop, future)
+        cls.requests.put((request_id, op, args))
+    if future is None:
+      return await loop.run_in_executor(cls._inline(), cls._handle_inline, op, args)
+    return await future
+
+  @classmethod
+  def _read_responses(cls) -> None:
+    """ Resolve pending requests as responses arrive (runs in a thread).
+        If the worker dies, fall back to the inline backend. """
+    while True:
+      try:
+        message = cls.responses.get(timeout=cls.liveness_period)
+      except queue.Empty:
+        if cls.process.is_alive():
+          continue
+        try: # its last responses may still be in transit
+          message = cls.responses.get(timeout=cls.liveness_period)
+        except queue.Empty:
+          cls._worker_died()
+          return
+      if message is None:
+        return
+      request_id, ok, result = message
+      with cls.lock:
+        loop, future = cls.pending.pop(request_id)
+      loop.call_soon_threadsafe(cls._resolve, future, ok, result)
+
+  @classmethod
+  def _worker_died(cls) -> None:
+    """ Fail the pending requests and handle later ones inline (runs in the
+        reader thread). Requests the worker hadn't handled are lost. """
+    with cls.lock:
+      debug_print(f"Storage worker died (exit code {cls.process.exitcode});"
+                  " unhandled requests were lost. Falling back to inline storage.")
+      cls.process = None
+      pending, cls.pending = cls.pending, {}
+    for loop, future in pending.values():
+      loop.call_soon_threadsafe(cls._resolve, future, False, RuntimeError("The storage worker died."))
+
+  @staticmethod
+  def _resolve(future: asyncio.Future, ok: bool, result) -> None:
+    """ Set the result (or exception) of a future unless it was cancelled. """
+    if future.cancelled():
+      return
+    if ok:
+      future.set_result(result)
+    else:
+      future.set_exception(result)
+
+  @classmethod
+  def close(cls) -> None:
+    """ Stop the worker process (or inline thread) after it handles every
+        queued request. """
+    if cls.process is None:
+      if cls.executor is not None:
+        cls.executor.submit(cls.backend.close) # in the thread that uses it
+        cls.executor.shutdown()
+        cls.executor = None
+      return
+    debug_print("Stopping storage worker...")
+    cls.requests.put(None)
+    cls.process.join()
+    cls.reader.join()
+    cls.process = None